@@ -0,0 +1,3 @@
+from benchmark.fake_spark import FakeSpark
+from benchmark.load import LoadGenerator
+from benchmark.scenarios import SCENARIOS, seed
@@ -0,0 +1,94 @@
+import sys
+import time
+import asyncio
+import argparse
+
+import pymongo
+from aiohttp import web
+
+import feedback
+from benchmark import FakeSpark, LoadGenerator, SCENARIOS, seed
+
+
+parser = argparse.ArgumentParser(description='Run the bot against a local Spark stand-in and measure it')
+parser.add_argument('scenario', choices=sorted(SCENARIOS))
+parser.add_argument('--events', type=int, default=1000, help='Webhooks to deliver. Default: 1000')
+parser.add_argument('--concurrency', type=int, default=50, help='Webhooks in flight at once. Default: 50')
+parser.add_argument('--customers', type=int, default=1000, help='Customers to seed. Default: 1000')
+parser.add_argument('--answers', type=int, default=10000, help='Answers to seed for get-answers. Default: 10000')
+parser.add_argument('--rooms', type=int, default=0, help='Membership webhooks mixed into the answer storm. Default: 0')
+parser.add_argument('--duplicates', type=float, default=0.0, help='Share of webhooks delivered twice. Default: 0')
+parser.add_argument('--latency', type=float, default=0.0, help='Mean Spark API latency in seconds. Default: 0')
+parser.add_argument('--error-rate', type=float, default=0.0, help='Share of message calls failing with 500. Default: 0')
+parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of message calls answered with 429. Default: 0')
+parser.add_argument('--retry-after', type=int, default=1, help='Retry-After sent with 429 responses. Default: 1')
+parser.add_argument('--timeout', type=float, default=300, help='Seconds to wait for replies. Default: 300')
+parser.add_argument('--database-uri', default='mongodb://127.0.0.1')
+parser.add_argument('--database', default='feedback_benchmark', help='Dropped and reseeded on every run')
+parser.add_argument('--bot-port', type=int, default=8990)
+parser.add_argument('--spark-port', type=int, default=8991)
+
+
+def percentile(values, point):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * point / 100))]
+
+
+def report(name, events, duration, load):
+    print('Scenario:    {}'.format(name))
+    print('Events:      {} in {:.2f}s, {:.1f} events/s'.format(events, duration, events / duration if duration else 0))
+    print('Rejected:    {}'.format(load.rejected))
+    print('Unanswered:  {}'.format(load.outstanding))
+    for label, values in (('Webhook ack', load.acks), ('Reply', load.replies)):
+        print('{:12} p50 {:.1f}ms  p90 {:.1f}ms  p99 {:.1f}ms  max {:.1f}ms'.format(
+            label + ':',
+            percentile(values, 50) * 1000,
+            percentile(values, 90) * 1000,
+            percentile(values, 99) * 1000,
+            max(values, default=0) * 1000))
+
+
+args = parser.parse_args()
+scenario, seed_question, seed_answers = SCENARIOS[args.scenario]
+
+client = pymongo.MongoClient(args.database_uri)
+client.drop_database(args.database)
+seed(client[args.database], args.customers, args.answers if seed_answers else 0, seed_question)
+client.close()
+
+loop = asyncio.get_event_loop()
+fake = FakeSpark(args.latency, args.error_rate, args.throttle_rate, args.retry_after)
+runner = web.AppRunner(fake.application())
+loop.run_until_complete(runner.setup())
+loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', args.spark_port).start())
+
+bot = feedback.Feedback({
+    'bot': {
+        'token': 'benchmark',
+        'port': args.bot_port,
+        'webhook': 'http://127.0.0.1:{}/'.format(args.bot_port),
+        'api_url': 'http://127.0.0.1:{}/v1/'.format(args.spark_port),
+        'queue_size': max(1000, args.events),
+    },
+    'database_uri': args.database_uri,
+    'database': args.database,
+})
+load = LoadGenerator(fake, 'http://127.0.0.1:{}/'.format(args.bot_port), args.duplicates)
+
+events = 0
+start = time.monotonic()
+try:
+    events = loop.run_until_complete(scenario(load, args))
+    loop.run_until_complete(load.wait(args.timeout))
+except asyncio.TimeoutError:
+    print('Timed out waiting for replies', file=sys.stderr)
+duration = time.monotonic() - start
+
+report(args.scenario, events, duration, load)
+
+loop.run_until_complete(load.close())
+bot.close()
+loop.run_until_complete(runner.cleanup())
+sys.exit(1 if load.outstanding else 0)
@@ -0,0 +1,110 @@
+import time
+import random
+import asyncio
+import itertools
+
+from aiohttp import web
+
+
+BOT_ID = 'bot'
+
+
+class FakeSpark:
+    def __init__(self, latency=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1):
+        self._latency = latency
+        self._error_rate = error_rate
+        self._throttle_rate = throttle_rate
+        self._retry_after = retry_after
+        self._ids = itertools.count()
+        self._messages = {}
+        self._webhooks = {}
+        self.sent = []
+        self.on_message = None
+
+    def application(self):
+        application = web.Application(middlewares=[self._faults])
+        application.router.add_get('/v1/people/me', self._people_me)
+        application.router.add_get('/v1/people/{id}', self._people_get)
+        application.router.add_get('/v1/messages/{id}', self._messages_get)
+        application.router.add_post('/v1/messages', self._messages_create)
+        application.router.add_get('/v1/webhooks', self._webhooks_list)
+        application.router.add_post('/v1/webhooks', self._webhooks_create)
+        application.router.add_delete('/v1/webhooks/{id}', self._webhooks_delete)
+        return application
+
+    def add_message(self, email, text):
+        id = 'message-{}'.format(next(self._ids))
+        self._messages[id] = {
+            'id': id,
+            'roomId': 'room-{}'.format(email),
+            'personId': person_id(email),
+            'personEmail': email,
+            'text': text,
+        }
+        return id
+
+    @web.middleware
+    async def _faults(self, request, handler):
+        # Webhook registration and people/me have to work, or the bot never starts
+        if not request.path.startswith('/v1/messages'):
+            return await handler(request)
+
+        if self._latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self._latency)
+
+        chance = random.random()
+        if chance < self._throttle_rate:
+            return web.json_response(
+                {'message': 'Too many requests'},
+                status=429,
+                headers={'Retry-After': str(self._retry_after)})
+        if chance < self._throttle_rate + self._error_rate:
+            return web.json_response({'message': 'Injected failure'}, status=500)
+        return await handler(request)
+
+    async def _people_me(self, request):
+        return web.json_response({'id': BOT_ID, 'displayName': 'Benchmark (bot)', 'emails': ['bot@benchmark']})
+
+    async def _people_get(self, request):
+        id = request.match_info['id']
+        return web.json_response({'id': id, 'displayName': id, 'emails': []})
+
+    async def _messages_get(self, request):
+        message = self._messages.get(request.match_info['id'])
+        if not message:
+            return web.json_response({'message': 'Not found'}, status=404)
+        return web.json_response(message)
+
+    async def _messages_create(self, request):
+        if request.content_type == 'application/json':
+            fields = await request.json()
+            files = False
+        else:
+            fields = await request.post()
+            files = 'files' in fields
+
+        now = time.monotonic()
+        to = fields.get('toPersonEmail') or fields.get('toPersonId') or fields.get('roomId')
+        text = fields.get('text') or fields.get('markdown')
+        self.sent.append((now, to, text, files))
+        if self.on_message:
+            self.on_message(to, text, files, now)
+
+        return web.json_response({'id': 'message-{}'.format(next(self._ids)), 'text': text})
+
+    async def _webhooks_list(self, request):
+        return web.json_response({'items': list(self._webhooks.values())})
+
+    async def _webhooks_create(self, request):
+        webhook = await request.json()
+        webhook['id'] = 'webhook-{}'.format(next(self._ids))
+        self._webhooks[webhook['id']] = webhook
+        return web.json_response(webhook)
+
+    async def _webhooks_delete(self, request):
+        self._webhooks.pop(request.match_info['id'], None)
+        return web.Response(status=204)
+
+
+def person_id(email):
+    return 'person-{}'.format(email)
@@ -0,0 +1,99 @@
+import time
+import random
+import asyncio
+import collections
+
+import aiohttp
+
+from benchmark.fake_spark import BOT_ID, person_id
+
+
+class LoadGenerator:
+    def __init__(self, fake, webhook_url, duplicates=0.0):
+        self._fake = fake
+        self._webhook_url = webhook_url
+        self._duplicates = duplicates
+        self._session = None
+        self._waiting = collections.defaultdict(collections.deque)
+        self._outstanding = 0
+        self._done = asyncio.Event()
+        self.acks = []
+        self.replies = []
+        self.rejected = 0
+        fake.on_message = self._replied
+
+    async def message(self, email, text, expect=None):
+        id = self._fake.add_message(email, text)
+        payload = {
+            'name': 'message created',
+            'resource': 'messages',
+            'event': 'created',
+            'actorId': person_id(email),
+            'data': {
+                'id': id,
+                'roomId': 'room-{}'.format(email),
+                'personId': person_id(email),
+                'personEmail': email,
+            },
+        }
+
+        if expect:
+            self._outstanding += 1
+            self._done.clear()
+            self._waiting[email].append((time.monotonic(), expect))
+
+        await self._post(payload)
+        # Spark redelivers webhooks it thinks were lost, the bot must only answer once
+        if random.random() < self._duplicates:
+            await self._post(payload)
+
+    async def room_created(self, email):
+        await self._post({
+            'name': 'room created',
+            'resource': 'memberships',
+            'event': 'created',
+            'actorId': person_id(email),
+            'data': {
+                'id': 'membership-{}'.format(email),
+                'roomId': 'room-{}'.format(email),
+                'personId': BOT_ID,
+            },
+        })
+
+    async def wait(self, timeout):
+        if self._outstanding:
+            await asyncio.wait_for(self._done.wait(), timeout)
+
+    @property
+    def outstanding(self):
+        return self._outstanding
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+
+    async def _post(self, payload):
+        if not self._session:
+            self._session = aiohttp.ClientSession()
+
+        start = time.monotonic()
+        async with self._session.post(self._webhook_url, json=payload) as response:
+            await response.read()
+            self.acks.append(time.monotonic() - start)
+            if response.status != 200:
+                self.rejected += 1
+
+    def _replied(self, to, text, files, now):
+        waiting = self._waiting.get(to)
+        if not waiting:
+            return
+
+        start, expect = waiting[0]
+        if not expect(text, files):
+            return
+
+        waiting.popleft()
+        self.replies.append(now - start)
+        self._outstanding -= 1
+        if not self._outstanding:
+            self._done.set()
@@ -0,0 +1,85 @@
+import random
+import datetime
+
+from feedback.fanout import FanOut
+
+
+CONTACT = 'contact@benchmark'
+
+
+def customer_email(index):
+    return 'customer{}@benchmark'.format(index)
+
+
+def seed(database, customers, answers, question=True):
+    now = datetime.datetime.utcnow()
+    database.contacts.insert_one({'_id': CONTACT, 'admin': True})
+    if customers:
+        database.customers.insert_many([
+            {'_id': customer_email(index), 'contact': CONTACT, 'customer': 'customer-{}'.format(index % 50)}
+            for index in range(customers)
+        ])
+    if not question:
+        return
+
+    question = database.questions.insert_one({'contact': CONTACT, 'text': 'How are we doing?', 'created': now}).inserted_id
+    for start in range(0, answers, 10000):
+        database.answers.insert_many([
+            {
+                'email': customer_email(index % max(customers, 1)),
+                'contact': CONTACT,
+                'customer': 'customer-{}'.format(index % 50),
+                'question': question,
+                'text': 'Answer number {}'.format(index),
+                'created': now,
+            }
+            for index in range(start, min(start + 10000, answers))
+        ])
+
+
+async def answer_storm(load, options):
+    emails = [customer_email(index) for index in range(options.customers)]
+
+    async def send(index):
+        if index < options.rooms:
+            await load.room_created(random.choice(emails))
+        await load.message(random.choice(emails), 'Answer {}'.format(index), _text('Thank you'))
+
+    await _run(send, options.events, options.concurrency)
+    return options.events
+
+
+async def large_ask(load, options):
+    await load.message(CONTACT, 'ask How are we doing?', _text('All customers asked'))
+    await load.wait(options.timeout)
+    return options.customers
+
+
+async def get_answers(load, options):
+    async def send(index):
+        await load.message(CONTACT, 'get answers', _files)
+
+    await _run(send, options.events, options.concurrency)
+    return options.events
+
+
+async def _run(send, count, concurrency):
+    failures = await FanOut(send, concurrency).run(range(count))
+    if failures:
+        raise next(iter(failures.values()))
+
+
+def _text(expected):
+    return lambda text, files: text == expected
+
+
+def _files(text, files):
+    return files
+
+
+# Name: (scenario, seed the current question, seed answers)
+SCENARIOS = {
+    'answers': (answer_storm, True, False),
+    'ask': (large_ask, False, False),
+    'get-answers': (get_answers, True, True),
+}
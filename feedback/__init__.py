@@ -1,14 +1,20 @@
+import sys
 import json
 import logging
+import datetime
 
-import pymongo
 import aiohttp
 import asyncio
-import tempfile
-import docx
-import ciscosparkapi
 
-from spark import Server
+from spark import Server, SparkApiError, RateLimitError, MongoDedup, MongoLock
+from feedback.fanout import FanOut
+from feedback.paging import MESSAGE_LIMIT, paginate
+from feedback.database import Database
+from feedback.cache import ContactCache
+from feedback.report import Reports, ReportCache, DOCX_TYPE
+from feedback.export import Export
+from feedback.outbox import Outbox
+from feedback.invalidation import Invalidations
 
 logger = logging.getLogger('Feedback')
 logger.setLevel(logging.INFO)
@@ -20,8 +26,9 @@ logger.addHandler(handler)
 help_message = '''
  * help - Show this message
  * ask `<question>` - Ask a question to all of your customers, also fetches the answers for your previous question
-    1. This removes the answers from the database. After this operation you alone have the answers to the previous question
+    1. Answers to previous questions are kept for a limited time before they are removed from the database
  * get answers - Fetch answers for your current question
+ * get new answers - Fetch only the answers that came in since you last fetched answers
  * add customer `<customer name>`: `<emails>` - Add customer, or emails to existing customer.
     1. customer name can not contain ':' characters
     2. customer name can contain spaces
@@ -31,6 +38,8 @@ help_message = '''
  * list customers - List all your customers
  * list emails `<customer>` - List emails for given customer
  * give customer `<receiver>` `<customer>` - Give customer to receiver
+ * list questions - List the questions you have asked
+ * export answers - Get a link to download the answers to your current question as CSV or JSON Lines
 '''
 
 admin_help = '''
@@ -41,205 +50,306 @@ admin_help = '''
  * list admins - List all administrators on the system
  * list contacts - List all contacts on the system
  * steal customer `<from>` `<customer>` - Steal customer from contact person
+ * cache stats - Show hit and miss counters for the contact cache
+ * list stalls - Show the latest times the bot stopped responding, and which command caused it
+ * profile `<seconds>` - Sample what the bot is busy with for the given number of seconds
 '''
 
 
+def explain(config):
+    database = Database(
+        config.get('database_uri', 'mongodb://127.0.0.1'),
+        config['database'],
+    )
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(database.ensure_indexes())
+        scans = loop.run_until_complete(database.explain())
+    finally:
+        database.close()
+
+    for collection, query, sort in scans:
+        logger.warn('Collection scan on {} for {} sorted by {}'.format(collection, query, sort))
+    if not scans:
+        logger.info('All queries are served by an index')
+    return 1 if scans else 0
+
 
 class Feedback:
     def __init__(self, config):
         self._states = {}
         self._next_id = {}
+        self._fanout_concurrency = config.get('fanout_concurrency', 20)
+        self._retention = datetime.timedelta(days=config.get('retention_days', 90))
+        self._retention_interval = config.get('retention_interval', 3600)
+        self._jobs = []
+        self._profile_limit = config.get('profile_limit', 60)
+        self._supervised = config.get('supervised', False)
+        self._database = Database(
+            config.get('database_uri', 'mongodb://127.0.0.1'),
+            config['database'],
+            config.get('database_workers', 4),
+        )
+        self._reports = Reports(
+            config.get('database_uri', 'mongodb://127.0.0.1'),
+            config['database'],
+            config.get('report_workers', 2),
+            config.get('report_batch_size', 500),
+        )
+        self._outbox = Outbox(
+            self._database,
+            self._fanout_concurrency,
+            config.get('outbox_batch_size', 100),
+            config.get('fanout_progress', 500),
+            config.get('outbox_lease', 300),
+            config.get('outbox_attempts', 5),
+        )
+        self._report_cache = ReportCache(
+            self._reports,
+            self._database.answers,
+            config.get('report_cache_size', 100),
+            config.get('report_cache_bytes', 64 * 1024 * 1024),
+        )
+        self._export = None
+        if 'export' in config:
+            self._export = Export(
+                self._database,
+                config['export']['secret'],
+                config['export']['url'],
+                config['export'].get('batch_size', 500),
+                config['export'].get('lifetime', 86400),
+            )
+        # Workers sharing a port tell each other when a contact changes
+        self._invalidations = None
+        if config.get('shared_cache', False):
+            self._invalidations = Invalidations(self._database)
+        self._contacts = ContactCache(
+            self._database.contacts,
+            config.get('contact_cache_ttl', 60),
+            config.get('contact_cache_size', 10000),
+            self._invalidations.publish if self._invalidations else None,
+        )
         self._setup_server(config)
-        client = pymongo.MongoClient('mongodb://127.0.0.1')
-        collection = client[config['database']]
-        self._db = collection['contacts']
-        self._customers = collection['customers']
 
     async def answer(self, api, message):
-        customer = self._customers.find_one({'_id': message.personEmail})
+        customer = await self._database.customers.get(message.personEmail)
         if not customer:
             return
 
-        answers = customer.get('answers', [])
-        answers.append(message.text)
-        self._customers.update({'_id': message.personEmail}, {'$set': {'answers': answers}})
+        question = await self._database.questions.current(customer['contact'])
+        if not question:
+            return
 
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
+        await self._database.answers.add(
+            message.personEmail,
+            customer['contact'],
+            customer['customer'],
+            question['_id'],
+            message.text)
+        self._report_cache.invalidate(customer['contact'])
+
+        await api.messages.create(
             None,
             None,
             message.personEmail,
             'Thank you')
 
-    async def get_answers(self, api, message):
-        contact = self._db.find_one({'_id': message.personEmail})
+    async def get_answers(self, api, message, args):
+        contact = await self._contacts.get(message.personEmail)
         if not contact:
-            answer(api, message)
+            await self.answer(api, message)
             return
 
         logger.info('{} is fetching answers'.format(message.personEmail))
-        old_question = contact.get('question', None)
+        old_question = await self._database.questions.current(message.personEmail)
         if old_question:
             await self._send_document(api, old_question, message.personEmail)
             return
 
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
+        await api.messages.create(
             None,
             None,
             message.personEmail,
             'You need to ask a question before fetching answers')
 
-    async def ask(self, api, message):
-        contact = self._db.find_one({'_id': message.personEmail})
+    async def get_new_answers(self, api, message, args):
+        contact = await self._contacts.get(message.personEmail)
+        if not contact:
+            await self.answer(api, message)
+            return
+
+        question = await self._database.questions.current(message.personEmail)
+        if not question:
+            await api.messages.create(
+                None,
+                None,
+                message.personEmail,
+                'You need to ask a question before fetching answers')
+            return
+
+        logger.info('{} is fetching new answers'.format(message.personEmail))
+        _, latest = await self._database.answers.tag(question['_id'])
+        fetched = question.get('fetched', None)
+        if not latest or (fetched and latest <= fetched):
+            await api.messages.create(
+                None,
+                None,
+                message.personEmail,
+                'No new answers since you last fetched answers')
+            return
+
+        document = await self._reports.build(question['_id'], fetched)
+        await api.messages.create(
+            None,
+            None,
+            message.personEmail,
+            'new answers',
+            None,
+            [('new_answers.docx', document, DOCX_TYPE)])
+        await self._database.questions.mark_fetched(question['_id'], latest)
+
+    async def ask(self, api, message, args):
+        contact = await self._contacts.get(message.personEmail)
         if not contact:
-            answer(api, message)
+            await self.answer(api, message)
             return
 
-        old_question = contact.get('question', None)
+        old_question = await self._database.questions.current(message.personEmail)
         if old_question:
             await self._send_document(api, old_question, message.personEmail)
 
-        self._customers.update(
-            {'contact': message.personEmail},
-            {'$unset': {'answers': 1}},
-            multi=True)
-        question = ' '.join(message.text.split(' ')[1:]).strip()
-        self._db.update({'_id': message.personEmail}, {'$set': {'question': question}})
+        question = args
+        await self._database.questions.add(message.personEmail, question)
 
         logger.info('{} is asking new question'.format(message.personEmail))
 
-        loop = asyncio.get_event_loop()
-        for customer in self._customers.find({'contact': message.personEmail}):
-            try:
-                await loop.run_in_executor(
-                    None,
-                    api.messages.create,
-                    None,
-                    None,
-                    customer['_id'],
-                    question)
-            except ciscosparkapi.exceptions.SparkApiError:
-                logger.warn('Can not send new question to {}'.format(customer['_id']))
-                await loop.run_in_executor(
-                    None,
-                    api.messages.create,
-                    None,
-                    None,
-                    message.personEmail,
-                    'Not able to send messages to {}'.format(customer['_id']))
+        customers = [customer['_id'] for customer in await self._database.customers.for_contact(message.personEmail, {'_id': True})]
+        if not customers:
+            await api.messages.create(
+                None,
+                None,
+                message.personEmail,
+                'All customers asked')
+            return
 
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
+        # The outbox delivers the question and tells the contact once everyone has been asked
+        await self._outbox.campaign(message.personEmail, customers, question)
+        await api.messages.create(
             None,
             None,
             message.personEmail,
-            'All customers asked')
+            'Asking {} customers, you will get a message when all of them have been asked'.format(len(customers)))
 
-    async def steal_customer(self, api, message):
-        loop = asyncio.get_event_loop()
-        contact = self._db.find_one({'_id': message.personEmail})
+    async def steal_customer(self, api, message, args):
+        contact = await self._contacts.get(message.personEmail)
         if not contact:
-            answer(api, message)
+            await self.answer(api, message)
             return
 
-        data = message.text.replace('steal customer', '').strip().split(' ')
+        data = args.split(' ')
         victim = data[0].strip()
         customer = ' '.join(data[1:]).strip()
 
         logger.info('{} stole customer {} from {}'.format(message.personEmail, customer, victim))
-        self._move_customer(victim, message.personEmail, customer)
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
+        await self._database.customers.move(customer, victim, message.personEmail)
+        await api.messages.create(
             None,
             None,
             message.personEmail,
             'Stole customer {} from {}'.format(customer, victim))
 
-    async def give_customer(self, api, message):
-        loop = asyncio.get_event_loop()
-        contact = self._db.find_one({'_id': message.personEmail})
+    async def give_customer(self, api, message, args):
+        contact = await self._contacts.get(message.personEmail)
         if not contact:
-            answer(api, message)
+            await self.answer(api, message)
             return
 
-        data = message.text.replace('give customer', '').strip().split(' ')
+        data = args.split(' ')
         receiver = data[0].strip()
         customer = ' '.join(data[1:]).strip()
 
         logger.info('{} gave customer {} to {}'.format(message.personEmail, customer, receiver))
-        self._move_customer(message.personEmail, receiver, customer)
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
+        await self._database.customers.move(customer, message.personEmail, receiver)
+        await api.messages.create(
             None,
             None,
             message.personEmail,
             'Moved customer {} to {}'.format(customer, receiver))
 
-    async def list_customers(self, api, message):
-        contact = self._db.find_one({'_id': message.personEmail})
+    async def list_customers(self, api, message, args):
+        contact = await self._contacts.get(message.personEmail)
         if not contact:
-            answer(api, message)
+            await self.answer(api, message)
             return
 
-        result = 'Your customers:'
-        customers = set(customer['customer'] for customer in self._customers.find({'contact': message.personEmail}))
-        for customer in customers:
-            result += '\n * {}'.format(customer)
+        customers = await self._database.customers.names(message.personEmail)
+        await self._send_list(
+            api,
+            message.personEmail,
+            'Your customers:',
+            ['{} ({} emails)'.format(customer['_id'], customer['emails']) for customer in customers])
 
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
-            None,
-            None,
+    async def list_questions(self, api, message, args):
+        contact = await self._contacts.get(message.personEmail)
+        if not contact:
+            await self.answer(api, message)
+            return
+
+        questions = await self._database.questions.for_contact(message.personEmail, {'text': True, 'created': True})
+        await self._send_list(
+            api,
             message.personEmail,
-            None,
-            result)
+            'Your questions:',
+            ['{:%Y-%m-%d}: {}'.format(question['created'], question['text']) for question in questions])
 
-    async def list_emails(self, api, message):
-        loop = asyncio.get_event_loop()
-        contact = self._db.find_one({'_id': message.personEmail})
+    async def export_answers(self, api, message, args):
+        contact = await self._contacts.get(message.personEmail)
         if not contact:
-            answer(api, message)
+            await self.answer(api, message)
             return
 
-        customer = message.text.replace('list emails', '').strip()
-        result = 'Emails registered for customer {}:'.format(customer)
-        for customer in self._customers.find({'customer': customer, 'contact': message.personEmail}):
-            result += '\n * {}'.format(customer['_id'])
+        if not self._export:
+            response = 'Export is not enabled on this bot'
+        else:
+            link = self._export.link(message.personEmail)
+            response = '\n'.join([
+                'Answers to your current question:',
+                ' * CSV: {}&format=csv'.format(link),
+                ' * JSON Lines: {}&format=jsonl'.format(link),
+                'Add limit=<n> to page through the answers, and after=<id of the last answer you got> to continue',
+                'The links stop working after {} hours'.format(self._export.lifetime // 3600),
+            ])
 
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
+        await api.messages.create(
             None,
             None,
             message.personEmail,
-            None,
-            result)
+            response)
 
-    async def add_customer(self, api, message):
-        loop = asyncio.get_event_loop()
-        is_contact = self._db.find_one({'_id': message.personEmail})
+    async def list_emails(self, api, message, args):
+        contact = await self._contacts.get(message.personEmail)
+        if not contact:
+            await self.answer(api, message)
+            return
+
+        customer = args
+        await self._send_list(
+            api,
+            message.personEmail,
+            'Emails registered for customer {}:'.format(customer),
+            await self._database.customers.emails(customer, message.personEmail))
+
+    async def add_customer(self, api, message, args):
+        is_contact = await self._contacts.get(message.personEmail)
         if not is_contact:
-            answer(api, message)
+            await self.answer(api, message)
             return
 
-        data = message.text.replace('add customer', '').strip().split(':')
+        data = args.split(':')
 
         if not len(data) > 1:
-            logger.warn('{} had wrong format when creating customer: {}'.format(message.text))
-            await loop.run_in_executor(
-                None,
-                api.messages.create,
+            logger.warn('{} had wrong format when creating customer: {}'.format(message.personEmail, message.text))
+            await api.messages.create(
                 None,
                 None,
                 message.personEmail,
@@ -252,248 +362,320 @@ class Feedback:
             emails.remove('')
 
         logger.info('{} added {} to customer {}'.format(message.personEmail, emails, customer))
-        question = is_contact.get('question', None)
-        for email in emails:
-            try:
-                if question:
-                    await loop.run_in_executor(
-                        None,
-                        api.messages.create,
-                        None,
-                        None,
-                        email,
-                        question)
-
-                self._customers.insert({'_id': email, 'contact': message.personEmail, 'customer': customer})
-            except ciscosparkapi.exceptions.SparkApiError as e:
-                logger.warn('{} Failed to send question to new user {}'.format(message.personEmail, email))
-                logger.warn(e)
-                await loop.run_in_executor(
+        duplicates = await self._database.customers.add_many(emails, message.personEmail, customer)
+        if duplicates:
+            logger.warn('{} is trying to re add {}'.format(message.personEmail, duplicates))
+
+        # The question goes out before any notice, so a failing notice can not keep it from new customers
+        failures = {}
+        question = await self._database.questions.current(message.personEmail)
+        added = emails - set(duplicates)
+        if question and added:
+            async def send(email):
+                await api.messages.create(
                     None,
-                    api.messages.create,
                     None,
-                    None,
-                    message.personEmail,
-                    'Not adding {} as we are not able to send a question to that address'.format(email))
-            except pymongo.errors.DuplicateKeyError:
-                logger.warn('{} is trying to re add {}'.format(message.personEmail, email))
-                await loop.run_in_executor(
-                    None,
-                    api.messages.create,
-                    None,
-                    None,
-                    message.personEmail,
-                    'Not adding {} as the address is already registers'.format(email))
+                    email,
+                    question['text'])
+
+            fanout = FanOut(send, self._fanout_concurrency, errors=(SparkApiError,))
+            failures = await fanout.run(added)
+            if failures:
+                await self._database.customers.remove(customer, message.personEmail, list(failures))
+
+            for email, error in failures.items():
+                logger.warn('{} Failed to send question to new user {}: {}'.format(message.personEmail, email, error))
+
+        limited = sorted(email for email, error in failures.items() if isinstance(error, RateLimitError))
+        failed = sorted(email for email, error in failures.items() if not isinstance(error, RateLimitError))
+        if duplicates:
+            await self._send_list(
+                api,
+                message.personEmail,
+                'Not adding these addresses as they are already registered:',
+                sorted(duplicates))
+        if failed:
+            await self._send_list(
+                api,
+                message.personEmail,
+                'Not adding these addresses as we are not able to send a question to them:',
+                failed)
+        if limited:
+            await self._send_list(
+                api,
+                message.personEmail,
+                'Not adding these addresses as Spark is rate limiting us, please try again later:',
+                limited)
 
-        customers = [customer['_id'] for customer in self._customers.find({'customer': customer, 'contact': message.personEmail})]
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
-            None,
-            None,
+        customers = await self._database.customers.emails(customer, message.personEmail)
+        await self._send_list(
+            api,
             message.personEmail,
-            '{} are now registered with {}'.format(customer, customers))
+            '{} are now registered with:'.format(customer),
+            customers)
 
-    async def remove_customer(self, api, message):
-        loop = asyncio.get_event_loop()
-        is_contact = self._db.find_one({'_id': message.personEmail})
+    async def remove_customer(self, api, message, args):
+        is_contact = await self._contacts.get(message.personEmail)
         if not is_contact:
-            answer(api, message)
+            await self.answer(api, message)
             return
 
-        data = message.text.replace('remove customer', '').strip().split(':')
+        data = args.split(':')
         customer = data[0]
         content = ''.join(data[1:]).strip()
 
         logger.info('{} removed {} from customer {}'.format(message.personEmail, content, customer))
-        self._remove_customer(message.personEmail, customer, content)
+        await self._remove_customer(message.personEmail, customer, content)
 
-        customers = [customer['_id'] for customer in self._customers.find({'customer': customer, 'contact': message.personEmail})]
+        customers = await self._database.customers.emails(customer, message.personEmail)
         result = '{} is completely removed'.format(customer)
         if customers:
             result = '{} are now registered with {}'.format(customer, customers)
 
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
+        await api.messages.create(
             None,
             None,
             message.personEmail,
             result)
 
-    async def add_admin(self, api, message):
-        is_admin = self._db.find_one({'_id': message.personEmail, 'admin': True})
+    async def add_admin(self, api, message, args):
+        is_admin = await self._contacts.get_admin(message.personEmail)
         if not is_admin:
-            answer(api, message)
+            await self.answer(api, message)
             return
 
-        email = message.text.replace('add admin', '').strip()
+        email = args
         response = '{} is already an admin'
-        entry = self._db.find_one({'_id': email})
+        entry = await self._database.contacts.get(email)
 
         if not entry:
-            self._db.insert({'_id': email, 'admin': True})
+            await self._database.contacts.add(email, admin=True)
+            self._contacts.invalidate(email)
             response = 'created {} as admin'
             logger.info('{} Created admin {}'.format(message.personEmail, email))
         elif not entry.get('admin', False):
-            self._db.update({'_id': email}, {'$set': {'admin': True}})
+            await self._database.contacts.set_admin(email, True)
+            self._contacts.invalidate(email)
             response = 'Gave admin privileges to {}'
             logger.info('{} Gave admin privileges to {}'.format(message.personEmail, email))
 
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
+        await api.messages.create(
             None,
             None,
             email,
             'You have been granted admin privileges')
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
+        await api.messages.create(
             None,
             None,
             message.personEmail,
             response.format(email))
 
-    async def remove_admin(self, api, message):
-        is_admin = self._db.find_one({'_id': message.personEmail, 'admin': True})
+    async def remove_admin(self, api, message, args):
+        is_admin = await self._contacts.get_admin(message.personEmail)
         if not is_admin:
-            answer(api, message)
+            await self.answer(api, message)
             return
 
-        email = message.text.replace('remove admin', '').strip()
-        entry = self._db.find_one({'_id': email, 'admin': True})
+        email = args
+        entry = await self._database.contacts.get_admin(email)
 
         if not entry:
             response = 'Could not find admin {}'.format(email)
         else:
-            self._db.update({'_id': email}, {'$set': {'admin': False}})
+            await self._database.contacts.set_admin(email, False)
+            self._contacts.invalidate(email)
             response = 'Removed admin privileges from {}'
             logger.info('{} removed admin privileges from {}'.format(message.personEmail, email))
 
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
+        await api.messages.create(
             None,
             None,
             email,
             'You have lost admin privileges')
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
+        await api.messages.create(
             None,
             None,
             message.personEmail,
             response.format(email))
 
-    async def add_contact(self, api, message):
-        is_admin = self._db.find_one({'_id': message.personEmail, 'admin': True})
+    async def add_contact(self, api, message, args):
+        is_admin = await self._contacts.get_admin(message.personEmail)
         if not is_admin:
-            answer(api, message)
+            await self.answer(api, message)
             return
 
-        email = message.text.replace('add contact', '').strip()
-        entry = self._db.find_one({'_id': email})
+        email = args
+        entry = await self._database.contacts.get(email)
         response = 'Contact {} already exists'
 
-        loop = asyncio.get_event_loop()
         if not entry:
-            self._db.insert({'_id': email, 'admin': False})
+            await self._database.contacts.add(email)
+            self._contacts.invalidate(email)
             response = 'Added {} as contact'
             logger.info('{} added {} as customer contact'.format(message.personEmail, email))
-            await loop.run_in_executor(
-                None,
-                api.messages.create,
+            await api.messages.create(
                 None,
                 None,
                 email,
                 'You have been added as a customer contact. Type help to see the commands you have available')
 
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
+        await api.messages.create(
             None,
             None,
             message.personEmail,
             response.format(email))
 
-    async def remove_contact(self, api, message):
-        is_admin = self._db.find_one({'_id': message.personEmail, 'admin': True})
+    async def remove_contact(self, api, message, args):
+        is_admin = await self._contacts.get_admin(message.personEmail)
         if not is_admin:
-            answer(api, message)
+            await self.answer(api, message)
             return
 
-        email = message.text.replace('remove contact', '').strip()
-        entry = self._db.find_one({'_id': email})
+        email = args
+        entry = await self._database.contacts.get(email)
         response = 'Contact {} does not exist'
 
         if entry:
             logger.info('{} removed {} as customer contact'.format(message.personEmail, email))
-            self._db.remove({'_id': email})
+            await self._database.contacts.remove(email)
+            self._contacts.invalidate(email)
             response = 'Removed {} from contacts'
-            await loop.run_in_executor(
-                None,
-                api.messages.create,
+            await api.messages.create(
                 None,
                 None,
                 email,
                 'You have been removed as a customer contact')
 
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
+        await api.messages.create(
             None,
             None,
             message.personEmail,
             response.format(email))
 
-    async def list_admins(self, api, message):
-        is_admin = self._db.find_one({'_id': message.personEmail, 'admin': True})
+    async def list_admins(self, api, message, args):
+        is_admin = await self._contacts.get_admin(message.personEmail)
         if not is_admin:
-            answer(api, message)
+            await self.answer(api, message)
             return
 
-        result = 'Administrators:'
-        administrators = self._db.find({'admin': True})
-        for admin in administrators:
-            result += '\n * {}'.format(admin['_id'])
+        await self._send_list(
+            api,
+            message.personEmail,
+            'Administrators:',
+            await self._database.contacts.admins())
 
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
+    async def list_contacts(self, api, message, args):
+        is_admin = await self._contacts.get_admin(message.personEmail)
+        if not is_admin:
+            await self.answer(api, message)
+            return
+
+        await self._send_list(
+            api,
+            message.personEmail,
+            'Contacts:',
+            await self._database.contacts.emails())
+
+    async def cache_stats(self, api, message, args):
+        is_admin = await self._contacts.get_admin(message.personEmail)
+        if not is_admin:
+            await self.answer(api, message)
+            return
+
+        lookups = self._contacts.hits + self._contacts.misses
+        hit_rate = 100.0 * self._contacts.hits / lookups if lookups else 0.0
+        await api.messages.create(
             None,
             None,
             message.personEmail,
-            None,
-            result)
+            'Contact cache: {} hits, {} misses ({:.1f}% hit rate)'.format(
+                self._contacts.hits,
+                self._contacts.misses,
+                hit_rate))
 
-    async def list_contacts(self, api, message):
-        is_admin = self._db.find_one({'_id': message.personEmail, 'admin': True})
+    async def list_stalls(self, api, message, args):
+        is_admin = await self._contacts.get_admin(message.personEmail)
         if not is_admin:
-            answer(api, message)
+            await self.answer(api, message)
             return
 
-        result = 'Contacts:'
-        administrators = self._db.find({})
-        for admin in administrators:
-            result += '\n * {}'.format(admin['_id'])
+        watchdog = self._server.watchdog
+        if not watchdog:
+            await api.messages.create(
+                None,
+                None,
+                message.personEmail,
+                'The watchdog is disabled')
+            return
 
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
+        stalls = ['{:%Y-%m-%d %H:%M:%S} {:.3f}s in {}: `{}`'.format(
+            stall['time'],
+            stall['duration'],
+            stall['handler'],
+            stall['stack'][-1].strip().splitlines()[0]) for stall in reversed(watchdog.stalls)]
+        if not stalls:
+            await api.messages.create(
+                None,
+                None,
+                message.personEmail,
+                'No stalls')
+            return
+        await self._send_list(api, message.personEmail, 'Stalls:', stalls)
+
+    async def profile(self, api, message, args):
+        is_admin = await self._contacts.get_admin(message.personEmail)
+        if not is_admin:
+            await self.answer(api, message)
+            return
+
+        watchdog = self._server.watchdog
+        if not watchdog:
+            await api.messages.create(
+                None,
+                None,
+                message.personEmail,
+                'The watchdog is disabled')
+            return
+        if watchdog.profiling:
+            await api.messages.create(
+                None,
+                None,
+                message.personEmail,
+                'A profile is already running')
+            return
+
+        try:
+            seconds = min(float(args), self._profile_limit)
+        except ValueError:
+            await api.messages.create(
+                None,
+                None,
+                message.personEmail,
+                'Usage: profile <seconds>')
+            return
+
+        logger.info('{} is profiling for {} seconds'.format(message.personEmail, seconds))
+        await api.messages.create(
             None,
             None,
             message.personEmail,
-            None,
-            result)
+            'Profiling for {} seconds'.format(seconds))
+        samples = await watchdog.profile(seconds)
+        total = sum(samples.values())
+        if not total:
+            await api.messages.create(
+                None,
+                None,
+                message.personEmail,
+                'No samples were taken')
+            return
+
+        lines = ['{:.1f}% {}: `{}`'.format(100.0 * count / total, handler, location)
+                 for (handler, location), count in samples.most_common(20)]
+        await self._send_list(api, message.personEmail, 'Profile, {} samples:'.format(total), lines)
 
-    async def help(self, api, message):
-        is_contact = self._db.find_one({'_id': message.personEmail})
+    async def help(self, api, message, args):
+        is_contact = await self._contacts.get(message.personEmail)
         if not is_contact:
             return
 
@@ -501,71 +683,103 @@ class Feedback:
         if is_contact.get('admin', False):
             response += admin_help
 
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None,
-            api.messages.create,
+        await api.messages.create(
             None,
             message.personId,
             None,
             None,
             response)
 
-    def _move_customer(self, from_contact, to_contact, customer):
-        self._customers.update(
-                {'customer': customer, 'contact': from_contact},
-                {'$set': {'contact': to_contact}},
-                multi=True)
-
-    def _remove_customer(self, contact, customer, to_remove):
+    async def _remove_customer(self, contact, customer, to_remove):
         if to_remove == 'all':
-            self._customers.remove({'customer': customer, 'contact': contact})
+            await self._database.customers.remove(customer, contact)
+            await self._database.answers.remove(customer, contact)
         else:
             emails = to_remove.split(' ')
-            for email in emails:
-                self._customers.remove({'_id': email, 'customer': customer, 'contact': contact})
-
-    async def _send_document(self, api, old_question, contact):
-        document = docx.Document()
-        document.add_heading(old_question, 0)
-
-        respondents = self._customers.find({'contact': contact, 'answers': {'$exists': True}})
+            await self._database.customers.remove(customer, contact, emails)
+            await self._database.answers.remove(customer, contact, emails)
 
-        for respondent in respondents:
-            document.add_heading('Customer: {}, email: {}'.format(respondent['customer'], respondent['_id']), 3)
-
-            for answer in respondent.get('answers', []):
-                document.add_paragraph(answer, style='List Number')
-
-        with tempfile.NamedTemporaryFile(prefix='answers_', suffix='.docx') as fd:
-            document.save(fd)
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                None,
-                api.messages.create,
+    async def _send_list(self, api, email, header, items):
+        for page in paginate(header, items):
+            await api.messages.create(
                 None,
                 None,
-                contact,
-                'answers',
+                email,
                 None,
-                [fd.name])
+                page)
+
+    async def _send_document(self, api, old_question, contact):
+        document, (_, latest) = await self._report_cache.get(contact, old_question['_id'])
+        await api.messages.create(
+            None,
+            None,
+            contact,
+            'answers',
+            None,
+            [('answers.docx', document, DOCX_TYPE)])
+        if latest:
+            await self._database.questions.mark_fetched(old_question['_id'], latest)
+
+    async def _start_jobs(self, api):
+        if self._server.primary:
+            self._jobs.append(asyncio.ensure_future(self._expire_questions()))
+        self._outbox.start(api)
+
+    async def _expire_questions(self):
+        while True:
+            try:
+                removed = await self._database.expire(datetime.datetime.utcnow() - self._retention)
+                if removed:
+                    logger.info('Removed {} expired questions'.format(removed))
+            except Exception:
+                logger.exception('Failed to remove expired questions')
+            await asyncio.sleep(self._retention_interval)
 
     def _setup_server(self, config):
         loop = asyncio.get_event_loop()
+        dedup = None
+        if config.get('persistent_dedup', True):
+            dedup = MongoDedup(
+                self._database.collection('messages'),
+                self._database.run,
+                config['bot'].get('dedup_size', 10000),
+                config['bot'].get('dedup_age', 3600),
+            )
+
+        # Workers behind one port may get events from the same sender at the same time
+        lock = None
+        if config.get('sender_lock', False):
+            lock = MongoLock(
+                self._database.collection('locks'),
+                self._database.run,
+                config.get('sender_lock_lease', 300),
+            )
+
         self._server = Server(
             config['bot'],
-            loop
+            loop,
+            dedup,
+            lock,
         )
         self._server.default_message(self.answer)
+        self._server.on_startup(self._start_jobs)
+        if self._export:
+            self._server.add_get('/export', self._export.handle)
         self._server.listen('^help$', self.help)
         self._server.listen('^ask ', self.ask)
         self._server.listen('^get answers$', self.get_answers)
+        self._server.listen('^get new answers$', self.get_new_answers)
         self._server.listen('^list admins$', self.list_admins)
         self._server.listen('^list contacts$', self.list_contacts)
         self._server.listen('^list customers$', self.list_customers)
+        self._server.listen('^list questions$', self.list_questions)
         self._server.listen('^list emails', self.list_emails)
+        self._server.listen('^export answers$', self.export_answers)
         self._server.listen('^give customer', self.give_customer)
         self._server.listen('^steal customer', self.steal_customer)
+        self._server.listen('^cache stats$', self.cache_stats)
+        self._server.listen('^list stalls$', self.list_stalls)
+        self._server.listen('^profile', self.profile)
         self._server.listen('^add admin', self.add_admin)
         self._server.listen('^add contact', self.add_contact)
         self._server.listen('^add customer', self.add_customer)
@@ -573,16 +787,37 @@ class Feedback:
         self._server.listen('^remove contact', self.remove_contact)
         self._server.listen('^remove customer', self.remove_customer)
 
+        if self._server.primary:
+            loop.run_until_complete(self._database.ensure_indexes())
+            loop.run_until_complete(self._database.migrate())
+        if self._invalidations:
+            loop.run_until_complete(self._invalidations.setup())
+            self._invalidations.start(loop, self._contacts.drop)
         loop.run_until_complete(self._server.setup())
 
     def run(self):
         loop = asyncio.get_event_loop()
         print('======== Bot Ready ========')
+        keep_webhooks = None
         try:
             loop.run_forever()
         except KeyboardInterrupt:
             pass
         except:
             print(sys.exc_info())
+            # The supervisor starts a new primary, the other workers keep serving the webhooks meanwhile
+            if self._supervised:
+                keep_webhooks = True
         finally:
-            loop.run_until_complete(self._server.cleanup())
+            self.close(keep_webhooks)
+
+    def close(self, keep_webhooks=None):
+        loop = asyncio.get_event_loop()
+        for job in self._jobs:
+            job.cancel()
+        self._outbox.stop()
+        if self._invalidations:
+            self._invalidations.stop()
+        loop.run_until_complete(self._server.cleanup(keep_webhooks))
+        self._reports.close()
+        self._database.close()
@@ -1,8 +1,10 @@
+import sys
 import json
 import argparse
 import os
 
 import feedback
+from feedback.supervisor import supervise
 
 
 parser = argparse.ArgumentParser()
@@ -13,11 +15,29 @@ parser.add_argument(
     default=default_config_file,
     help='Path to configuration file. Default: {}'.format(default_config_file)
 )
+parser.add_argument(
+    '--explain',
+    action='store_true',
+    help='Create missing indexes, then check that every query the bot issues is served by an index'
+)
+parser.add_argument(
+    '--workers',
+    '-w',
+    type=int,
+    default=1,
+    help='Number of processes serving webhooks on the same port. Default: 1'
+)
 
 args = parser.parse_args()
 
 with open(args.config, 'r') as fd:
     config = json.load(fd)
 
+if args.explain:
+    sys.exit(feedback.explain(config))
+
+if args.workers > 1:
+    sys.exit(supervise(config, args.workers))
+
 bot = feedback.Feedback(config)
 bot.run()
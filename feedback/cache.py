@@ -0,0 +1,57 @@
+import time
+import collections
+
+from spark.metrics import REGISTRY
+
+LOOKUPS = REGISTRY.counter('feedback_contact_cache_total', 'Contact cache lookups', ['result'])
+
+
+class ContactCache:
+    def __init__(self, contacts, ttl=60, size=10000, broadcast=None):
+        self._contacts = contacts
+        self._broadcast = broadcast
+        self._ttl = ttl
+        self._size = size
+        # Non contacts are cached as well, most messages come from customers
+        self._entries = collections.OrderedDict()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, email):
+        now = time.monotonic()
+        entry = self._entries.get(email)
+        if entry and now - entry[0] < self._ttl:
+            self.hits += 1
+            LOOKUPS.inc(result='hit')
+            return entry[1]
+
+        self.misses += 1
+        LOOKUPS.inc(result='miss')
+        version = self._version
+        contact = await self._contacts.get(email)
+        # Do not store a record that was invalidated while we were reading it
+        if version == self._version:
+            self._store(email, now, contact)
+        return contact
+
+    async def get_admin(self, email):
+        contact = await self.get(email)
+        if contact and contact.get('admin', False):
+            return contact
+        return None
+
+    def invalidate(self, email):
+        self.drop(email)
+        if self._broadcast:
+            self._broadcast(email)
+
+    def drop(self, email):
+        self._version += 1
+        self._entries.pop(email, None)
+
+    def _store(self, email, now, contact):
+        self._entries.pop(email, None)
+        self._entries[email] = (now, contact)
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
@@ -0,0 +1,497 @@
+import datetime
+
+import pymongo
+from bson.son import SON
+from bson.objectid import ObjectId
+
+from spark.metrics import REGISTRY
+from spark.pools import Pool
+
+OPERATION_SECONDS = REGISTRY.histogram('database_operation_seconds', 'Time spent in MongoDB operations', ['operation'])
+
+
+class Database:
+    def __init__(self, uri, name, workers=4):
+        self._client = pymongo.MongoClient(uri)
+        self._database = self._client[name]
+        # pymongo is blocking, so every query runs on this pool instead of the event loop
+        self._pool = Pool.threads('database', workers)
+        self._pending = 0
+        REGISTRY.gauge('database_pending_operations', 'Database operations queued or running', function=lambda: self._pending)
+        self.contacts = Contacts(self, self._database['contacts'])
+        self.customers = Customers(self, self._database['customers'])
+        self.answers = Answers(self, self._database['answers'])
+        self.questions = Questions(self, self._database['questions'])
+        self.outbox = OutboxMessages(self, self._database['outbox'])
+        self.campaigns = Campaigns(self, self._database['campaigns'])
+
+    def collection(self, name):
+        return self._database[name]
+
+    async def run(self, function, *args, operation=None, **kwargs):
+        if operation is None:
+            operation = getattr(function, '__name__', 'call').lstrip('_')
+
+        self._pending += 1
+        try:
+            with OPERATION_SECONDS.time(operation=operation):
+                return await self._pool.run(function, *args, **kwargs)
+        finally:
+            self._pending -= 1
+
+    async def ensure_indexes(self):
+        await self.run(self._ensure_indexes)
+
+    async def explain(self):
+        return await self.run(self._explain)
+
+    async def migrate(self):
+        await self.run(self._migrate_questions)
+        await self.run(self._migrate_answers)
+
+    async def expire(self, before):
+        return await self.run(self._expire, before)
+
+    def close(self):
+        self._pool.close()
+        self._client.close()
+
+    def _ensure_indexes(self):
+        for collection, indexes in INDEXES.items():
+            for keys in indexes:
+                self._database[collection].create_index(keys)
+
+    def _explain(self):
+        scans = []
+        for collection, query, sort in query_shapes():
+            cursor = self._database[collection].find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            plan = cursor.explain()['queryPlanner']['winningPlan']
+            if 'COLLSCAN' in _stages(plan):
+                scans.append((collection, query, sort))
+        return scans
+
+    def _migrate_questions(self):
+        # The current question used to be a plain string on the contact
+        contacts = self._database['contacts']
+        questions = self._database['questions']
+        answers = self._database['answers']
+        now = datetime.datetime.utcnow()
+        for contact in contacts.find({'question': {'$exists': True}}):
+            if contact['question']:
+                question = 'migrated:{}'.format(contact['_id'])
+                try:
+                    questions.insert_one({'_id': question, 'contact': contact['_id'], 'text': contact['question'], 'created': now})
+                except pymongo.errors.DuplicateKeyError:
+                    pass
+                answers.update_many(
+                    {'contact': contact['_id'], 'question': {'$exists': False}},
+                    {'$set': {'question': question}})
+            contacts.update_one({'_id': contact['_id']}, {'$unset': {'question': 1}})
+
+    def _migrate_answers(self):
+        # Answers used to be an array on the customer document
+        customers = self._database['customers']
+        questions = self._database['questions']
+        answers = self._database['answers']
+        now = datetime.datetime.utcnow()
+        for customer in customers.find({'answers': {'$exists': True}}):
+            question = questions.find_one({'contact': customer['contact']}, {'_id': True}, sort=Questions.latest)
+            documents = [
+                {
+                    # Stable ids make the migration safe to rerun after a crash
+                    '_id': '{}:{}'.format(customer['_id'], index),
+                    'email': customer['_id'],
+                    'contact': customer['contact'],
+                    'customer': customer['customer'],
+                    'question': question['_id'] if question else None,
+                    'text': text,
+                    'created': now,
+                }
+                for index, text in enumerate(customer['answers'])
+            ]
+            if documents:
+                try:
+                    answers.insert_many(documents, ordered=False)
+                except pymongo.errors.BulkWriteError as e:
+                    if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                        raise
+            customers.update_one({'_id': customer['_id']}, {'$unset': {'answers': 1}})
+
+    def _expire(self, before):
+        questions = self._database['questions']
+        answers = self._database['answers']
+        # The current question of every contact is kept, no matter how old it is
+        current = set(
+            question['question']
+            for question in questions.aggregate([
+                {'$sort': SON(Questions.latest)},
+                {'$group': {'_id': '$contact', 'question': {'$first': '$_id'}}},
+            ]))
+        expired = [
+            question['_id']
+            for question in questions.find({'created': {'$lt': before}}, {'_id': True})
+            if question['_id'] not in current
+        ]
+        if expired:
+            answers.delete_many({'question': {'$in': expired}})
+            questions.delete_many({'_id': {'$in': expired}})
+
+        # Finished campaigns only have their outbox kept around for the summary
+        campaigns = self._database['campaigns']
+        finished = [
+            campaign['_id']
+            for campaign in campaigns.find({'done': True, 'created': {'$lt': before}}, {'_id': True})
+        ]
+        if finished:
+            self._database['outbox'].delete_many({'campaign': {'$in': finished}})
+            campaigns.delete_many({'_id': {'$in': finished}})
+        return len(expired)
+
+
+INDEXES = {
+    'contacts': [
+        [('admin', pymongo.ASCENDING)],
+    ],
+    'customers': [
+        [('contact', pymongo.ASCENDING)],
+        [('customer', pymongo.ASCENDING), ('contact', pymongo.ASCENDING)],
+    ],
+    'answers': [
+        [('question', pymongo.ASCENDING), ('customer', pymongo.ASCENDING), ('email', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+        [('question', pymongo.ASCENDING), ('created', pymongo.DESCENDING)],
+        [('question', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+        [('customer', pymongo.ASCENDING), ('contact', pymongo.ASCENDING), ('email', pymongo.ASCENDING)],
+    ],
+    'questions': [
+        [('contact', pymongo.ASCENDING), ('created', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
+        [('created', pymongo.ASCENDING)],
+    ],
+    'outbox': [
+        [('state', pymongo.ASCENDING), ('created', pymongo.ASCENDING)],
+        [('state', pymongo.ASCENDING), ('claimed', pymongo.ASCENDING)],
+        [('campaign', pymongo.ASCENDING), ('state', pymongo.ASCENDING)],
+    ],
+    'campaigns': [
+        [('done', pymongo.ASCENDING), ('created', pymongo.ASCENDING)],
+    ],
+}
+
+
+def query_shapes():
+    # One example of every query the bot issues, the values do not matter to the planner
+    now = datetime.datetime.utcnow()
+    answer_order = [('customer', pymongo.ASCENDING), ('email', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+    return [
+        ('contacts', {'_id': ''}, None),
+        ('contacts', {'_id': '', 'admin': True}, None),
+        ('contacts', {'admin': True}, None),
+        ('customers', {'_id': ''}, None),
+        ('customers', {'contact': ''}, None),
+        ('customers', {'customer': '', 'contact': ''}, None),
+        ('customers', {'_id': {'$in': ['']}, 'customer': '', 'contact': ''}, None),
+        ('answers', {'question': ObjectId()}, answer_order),
+        ('answers', {'question': ObjectId(), 'created': {'$gt': now}}, answer_order),
+        ('answers', {'question': ObjectId()}, [('created', pymongo.DESCENDING)]),
+        ('answers', {'question': ObjectId(), '_id': {'$gt': ObjectId()}}, [('_id', pymongo.ASCENDING)]),
+        ('answers', {'customer': '', 'contact': '', 'email': {'$in': ['']}}, None),
+        ('answers', {'question': {'$in': [ObjectId()]}}, None),
+        ('questions', {'contact': ''}, Questions.latest),
+        ('questions', {'created': {'$lt': now}}, None),
+        ('outbox', {'$or': [{'state': 'pending'}, {'state': 'sending', 'claimed': {'$lt': now}}]}, [('created', pymongo.ASCENDING)]),
+        ('outbox', {'campaign': ObjectId(), 'state': {'$in': ['pending', 'sending']}}, None),
+        ('outbox', {'campaign': ObjectId(), 'state': 'failed'}, None),
+        ('outbox', {'campaign': {'$in': [ObjectId()]}}, None),
+        ('campaigns', {'done': False}, None),
+        ('campaigns', {'done': True, 'created': {'$lt': now}}, None),
+    ]
+
+
+def _stages(plan):
+    if isinstance(plan, dict):
+        stages = [plan['stage']] if 'stage' in plan else []
+        for value in plan.values():
+            stages.extend(_stages(value))
+        return stages
+    if isinstance(plan, list):
+        return [stage for value in plan for stage in _stages(value)]
+    return []
+
+
+class _Collection:
+    def __init__(self, database, collection):
+        self._database = database
+        self._collection = collection
+
+    async def _run(self, function, *args, **kwargs):
+        operation = '{}.{}'.format(self._collection.name, function.__name__.lstrip('_'))
+        return await self._database.run(function, *args, operation=operation, **kwargs)
+
+    def _find(self, *args, **kwargs):
+        return list(self._collection.find(*args, **kwargs))
+
+    def _aggregate(self, pipeline):
+        return list(self._collection.aggregate(pipeline))
+
+
+class Contacts(_Collection):
+    async def get(self, email):
+        return await self._run(self._collection.find_one, {'_id': email})
+
+    async def get_admin(self, email):
+        return await self._run(self._collection.find_one, {'_id': email, 'admin': True})
+
+    async def add(self, email, admin=False):
+        await self._run(self._collection.insert_one, {'_id': email, 'admin': admin})
+
+    async def set_admin(self, email, admin):
+        await self._run(self._collection.update_one, {'_id': email}, {'$set': {'admin': admin}})
+
+    async def remove(self, email):
+        await self._run(self._collection.delete_one, {'_id': email})
+
+    async def admins(self):
+        return sorted(await self._run(self._collection.distinct, '_id', {'admin': True}))
+
+    async def emails(self):
+        return sorted(await self._run(self._collection.distinct, '_id'))
+
+
+class Customers(_Collection):
+    async def get(self, email):
+        return await self._run(self._collection.find_one, {'_id': email})
+
+    async def add_many(self, emails, contact, customer):
+        return await self._run(
+            self._add_many,
+            [{'_id': email, 'contact': contact, 'customer': customer} for email in emails])
+
+    async def for_contact(self, contact, projection=None):
+        return await self._run(self._find, {'contact': contact}, projection)
+
+    async def emails(self, customer, contact):
+        return sorted(await self._run(self._collection.distinct, '_id', {'customer': customer, 'contact': contact}))
+
+    async def names(self, contact):
+        return await self._run(self._aggregate, [
+            {'$match': {'contact': contact}},
+            {'$group': {'_id': '$customer', 'emails': {'$sum': 1}}},
+            {'$sort': {'_id': 1}},
+        ])
+
+    async def move(self, customer, from_contact, to_contact):
+        await self._run(
+            self._collection.update_many,
+            {'customer': customer, 'contact': from_contact},
+            {'$set': {'contact': to_contact}})
+
+    async def remove(self, customer, contact, emails=None):
+        if emails is None:
+            await self._run(self._collection.delete_many, {'customer': customer, 'contact': contact})
+            return
+
+        await self._run(
+            self._collection.delete_many,
+            {'_id': {'$in': emails}, 'customer': customer, 'contact': contact})
+
+    def _add_many(self, documents):
+        if not documents:
+            return []
+
+        # Unordered, so one address that is already registered does not stop the rest
+        try:
+            self._collection.insert_many(documents, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            errors = e.details['writeErrors']
+            if any(error['code'] != 11000 for error in errors):
+                raise
+            return [documents[error['index']]['_id'] for error in errors]
+        return []
+
+
+class Answers(_Collection):
+    async def add(self, email, contact, customer, question, text):
+        await self._run(
+            self._collection.insert_one,
+            {
+                'email': email,
+                'contact': contact,
+                'customer': customer,
+                'question': question,
+                'text': text,
+                'created': datetime.datetime.utcnow(),
+            })
+
+    async def batches(self, question, after=None, size=500, limit=None):
+        # Keyset pagination on _id, so every batch is an indexed range query
+        # and the last _id of a batch doubles as a resume token
+        remaining = limit
+        while remaining is None or remaining > 0:
+            count = size if remaining is None else min(size, remaining)
+            batch = await self._run(
+                self._find,
+                self._after(question, after),
+                {'contact': False},
+                sort=[('_id', pymongo.ASCENDING)],
+                limit=count)
+            if not batch:
+                return
+
+            yield batch
+            if len(batch) < count:
+                return
+
+            after = batch[-1]['_id']
+            if remaining is not None:
+                remaining -= len(batch)
+
+    async def tag(self, question):
+        return await self._run(self._tag, question)
+
+    async def remove(self, customer, contact, emails=None):
+        query = {'customer': customer, 'contact': contact}
+        if emails is not None:
+            query['email'] = {'$in': emails}
+        await self._run(self._collection.delete_many, query)
+
+    def _after(self, question, after):
+        if after is None:
+            return {'question': question}
+        if isinstance(after, ObjectId):
+            return {'question': question, '_id': {'$gt': after}}
+        # Migrated answers have string ids, which sort before every ObjectId
+        return {
+            'question': question,
+            '$or': [{'_id': {'$gt': after}}, {'_id': {'$type': 'objectId'}}],
+        }
+
+    def _tag(self, question):
+        count = self._collection.count_documents({'question': question})
+        latest = self._collection.find_one(
+            {'question': question},
+            {'_id': False, 'created': True},
+            sort=[('created', pymongo.DESCENDING)])
+        return count, latest['created'] if latest else None
+
+
+class Questions(_Collection):
+    latest = [('created', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+
+    async def add(self, contact, text):
+        result = await self._run(
+            self._collection.insert_one,
+            {'contact': contact, 'text': text, 'created': datetime.datetime.utcnow()})
+        return result.inserted_id
+
+    async def current(self, contact):
+        return await self._run(self._collection.find_one, {'contact': contact}, sort=self.latest)
+
+    async def get(self, question, contact):
+        return await self._run(self._collection.find_one, {'_id': question, 'contact': contact})
+
+    async def for_contact(self, contact, projection=None):
+        return await self._run(self._find, {'contact': contact}, projection, sort=self.latest)
+
+    async def mark_fetched(self, question, fetched):
+        await self._run(self._collection.update_one, {'_id': question}, {'$set': {'fetched': fetched}})
+
+
+class OutboxMessages(_Collection):
+    async def add_many(self, campaign, recipients, text):
+        now = datetime.datetime.utcnow()
+        await self._run(
+            self._collection.insert_many,
+            [
+                {'campaign': campaign, 'to': to, 'text': text, 'state': 'pending', 'attempts': 0, 'created': now}
+                for to in recipients
+            ],
+            ordered=False)
+
+    async def claim(self, count, lease):
+        return await self._run(self._claim, count, lease)
+
+    async def delivered(self, ids):
+        await self._run(
+            self._collection.update_many,
+            {'_id': {'$in': ids}},
+            {'$set': {'state': 'delivered'}, '$unset': {'claimed': 1}})
+
+    async def failed(self, id, error, rate_limited=False):
+        await self._run(
+            self._collection.update_one,
+            {'_id': id},
+            {'$set': {'state': 'failed', 'error': error, 'rate_limited': rate_limited}, '$unset': {'claimed': 1}})
+
+    async def release(self, id):
+        await self._run(
+            self._collection.update_one,
+            {'_id': id},
+            {'$set': {'state': 'pending'}, '$unset': {'claimed': 1}})
+
+    async def unfinished(self, campaign):
+        return await self._run(
+            self._collection.count_documents,
+            {'campaign': campaign, 'state': {'$in': ['pending', 'sending']}})
+
+    async def failures(self, campaign):
+        return await self._run(
+            self._find,
+            {'campaign': campaign, 'state': 'failed'},
+            {'_id': False, 'to': True, 'rate_limited': True})
+
+    def _claim(self, count, lease):
+        now = datetime.datetime.utcnow()
+        claimed = []
+        for _ in range(count):
+            # Messages claimed by a sender that died are picked up again once the lease runs out
+            message = self._collection.find_one_and_update(
+                {'$or': [
+                    {'state': 'pending'},
+                    {'state': 'sending', 'claimed': {'$lt': now - datetime.timedelta(seconds=lease)}},
+                ]},
+                {'$set': {'state': 'sending', 'claimed': now}, '$inc': {'attempts': 1}},
+                sort=[('created', pymongo.ASCENDING)],
+                return_document=pymongo.ReturnDocument.AFTER)
+            if not message:
+                break
+            claimed.append(message)
+        return claimed
+
+
+class Campaigns(_Collection):
+    async def add(self, campaign, contact, text, total):
+        await self._run(
+            self._collection.insert_one,
+            {'_id': campaign, 'contact': contact, 'text': text, 'total': total, 'processed': 0, 'done': False,
+             'created': datetime.datetime.utcnow()})
+
+    async def processed(self, campaign, count):
+        return await self._run(
+            self._collection.find_one_and_update,
+            {'_id': campaign},
+            {'$inc': {'processed': count}},
+            return_document=pymongo.ReturnDocument.AFTER)
+
+    async def claim(self, campaign, lease):
+        # Only one sender at a time gets the campaign back to send its summary
+        now = datetime.datetime.utcnow()
+        return await self._run(
+            self._collection.find_one_and_update,
+            {'_id': campaign, 'done': False, '$or': [
+                {'finishing': {'$exists': False}},
+                {'finishing': {'$lt': now - datetime.timedelta(seconds=lease)}},
+            ]},
+            {'$set': {'finishing': now}, '$inc': {'summary_attempts': 1}})
+
+    async def release(self, campaign):
+        await self._run(self._collection.update_one, {'_id': campaign}, {'$unset': {'finishing': 1}})
+
+    async def finish(self, campaign):
+        await self._run(
+            self._collection.update_one,
+            {'_id': campaign},
+            {'$set': {'done': True}, '$unset': {'finishing': 1}})
+
+    async def unfinished(self):
+        return await self._run(self._find, {'done': False}, {'_id': True})
@@ -0,0 +1,118 @@
+import io
+import csv
+import hmac
+import json
+import time
+import hashlib
+import urllib.parse
+
+from aiohttp import web
+from bson.objectid import ObjectId
+
+
+FIELDS = ['id', 'question', 'customer', 'email', 'created', 'text']
+
+
+class Export:
+    def __init__(self, database, secret, url, batch_size=500, lifetime=86400):
+        self._database = database
+        self._secret = secret.encode()
+        self._url = url
+        self._batch_size = batch_size
+        self.lifetime = lifetime
+
+    def link(self, contact):
+        expires = int(time.time()) + self.lifetime
+        return '{}?{}'.format(
+            self._url,
+            urllib.parse.urlencode({'contact': contact, 'expires': expires, 'token': self._token(contact, expires)}))
+
+    async def handle(self, api, request):
+        contact = request.query.get('contact', '')
+        try:
+            expires = int(request.query.get('expires', ''))
+        except ValueError:
+            return 'Forbidden', 403, 'text/plain'
+        if not contact or not hmac.compare_digest(self._token(contact, expires), request.query.get('token', '')):
+            return 'Forbidden', 403, 'text/plain'
+        if expires < time.time():
+            return 'This link has expired, ask the bot for a new one', 403, 'text/plain'
+        # Removing a contact revokes the links that were handed out to it
+        if not await self._database.contacts.get(contact):
+            return 'Forbidden', 403, 'text/plain'
+
+        format = request.query.get('format', 'csv')
+        if format not in _FORMATS:
+            return 'Unknown format {}'.format(format), 400, 'text/plain'
+
+        try:
+            limit = int(request.query['limit']) if 'limit' in request.query else None
+        except ValueError:
+            return 'limit must be a number', 400, 'text/plain'
+
+        if 'question' in request.query:
+            question = await self._database.questions.get(_parse_id(request.query['question']), contact)
+        else:
+            question = await self._database.questions.current(contact)
+        if not question:
+            return 'No such question', 404, 'text/plain'
+
+        after = request.query.get('after', None)
+        if after is not None:
+            after = _parse_id(after)
+
+        content_type, extension, render = _FORMATS[format]
+        response = web.StreamResponse(headers={
+            'Content-Type': content_type,
+            'Content-Disposition': 'attachment; filename="answers.{}"'.format(extension),
+        })
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+
+        if format == 'csv' and after is None:
+            await response.write(_csv([FIELDS]))
+
+        # Only one batch of answers is held in memory at any time
+        async for batch in self._database.answers.batches(question['_id'], after, self._batch_size, limit):
+            await response.write(render([_row(answer) for answer in batch]))
+
+        await response.write_eof()
+        return response
+
+    def _token(self, contact, expires):
+        message = '{}\n{}'.format(contact, expires).encode()
+        return hmac.new(self._secret, message, hashlib.sha256).hexdigest()
+
+
+def _parse_id(value):
+    # Migrated records keep their string ids
+    if ObjectId.is_valid(value):
+        return ObjectId(value)
+    return value
+
+
+def _row(answer):
+    return [
+        str(answer['_id']),
+        str(answer['question']),
+        answer['customer'],
+        answer['email'],
+        answer['created'].isoformat(),
+        answer['text'],
+    ]
+
+
+def _csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def _jsonl(rows):
+    return ''.join(json.dumps(dict(zip(FIELDS, row))) + '\n' for row in rows).encode()
+
+
+_FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv', _csv),
+    'jsonl': ('application/x-ndjson', 'jsonl', _jsonl),
+}
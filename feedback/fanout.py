@@ -0,0 +1,31 @@
+import asyncio
+
+from spark.metrics import REGISTRY
+
+FAILURES = REGISTRY.counter('feedback_outbound_failures_total', 'Outbound messages that could not be delivered', ['reason'])
+
+
+class FanOut:
+    def __init__(self, send, concurrency=20, errors=(Exception,)):
+        self._send = send
+        self._concurrency = max(1, concurrency)
+        self._errors = errors
+
+    async def run(self, recipients):
+        recipients = list(recipients)
+        pending = iter(recipients)
+        failures = {}
+
+        async def worker():
+            # All workers share one iterator, so each recipient is only sent once
+            for recipient in pending:
+                try:
+                    await self._send(recipient)
+                except self._errors as e:
+                    FAILURES.inc(reason=type(e).__name__)
+                    failures[recipient] = e
+
+        workers = min(self._concurrency, len(recipients))
+        if workers:
+            await asyncio.gather(*[worker() for _ in range(workers)])
+        return failures
@@ -0,0 +1,69 @@
+import uuid
+import asyncio
+import logging
+import threading
+
+import pymongo
+
+logger = logging.getLogger('Feedback')
+
+
+class Invalidations:
+    def __init__(self, database, size=1048576):
+        self._database = database
+        self._collection = database.collection('invalidations')
+        self._size = size
+        self._origin = uuid.uuid4().hex
+        self._stopped = threading.Event()
+        self._thread = None
+
+    async def setup(self):
+        await self._database.run(self._create)
+
+    def publish(self, key):
+        asyncio.ensure_future(self._publish(key))
+
+    def start(self, loop, callback):
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._tail,
+            args=(loop, callback),
+            name='invalidations',
+            daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    async def _publish(self, key):
+        try:
+            await self._database.run(self._collection.insert_one, {'key': key, 'origin': self._origin})
+        except Exception:
+            logger.exception('Failed to publish invalidation of {}'.format(key))
+
+    def _create(self):
+        # Capped, so old invalidations roll off by themselves and the collection can be tailed
+        try:
+            self._collection.database.create_collection(self._collection.name, capped=True, size=self._size)
+        except pymongo.errors.CollectionInvalid:
+            pass
+
+    def _tail(self, loop, callback):
+        # Replaying old invalidations only drops cache entries, so every cursor starts from the beginning
+        while not self._stopped.is_set():
+            try:
+                cursor = self._collection.find(
+                    cursor_type=pymongo.CursorType.TAILABLE_AWAIT,
+                    max_await_time_ms=1000)
+                while cursor.alive and not self._stopped.is_set():
+                    for document in cursor:
+                        if document.get('origin') != self._origin:
+                            loop.call_soon_threadsafe(callback, document['key'])
+            except Exception:
+                logger.exception('Failed to read invalidations')
+
+            # A tailable cursor on an empty collection dies right away
+            self._stopped.wait(1)
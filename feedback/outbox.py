@@ -0,0 +1,162 @@
+import asyncio
+import logging
+
+from bson.objectid import ObjectId
+
+from spark import SparkApiError, RateLimitError
+from feedback.fanout import FanOut
+from feedback.paging import paginate
+
+logger = logging.getLogger('Feedback')
+
+
+class Outbox:
+    def __init__(self, database, concurrency=20, batch_size=100, progress_interval=500,
+                 lease=300, max_attempts=5, interval=30):
+        self._database = database
+        self._concurrency = concurrency
+        self._batch_size = batch_size
+        self._progress_interval = progress_interval
+        self._lease = lease
+        self._max_attempts = max_attempts
+        self._interval = interval
+        self._wake = asyncio.Event()
+        self._task = None
+
+    async def campaign(self, contact, recipients, text):
+        # Messages go in before their campaign, a campaign without them would be summarised right away
+        campaign = ObjectId()
+        if recipients:
+            await self._database.outbox.add_many(campaign, recipients, text)
+        await self._database.campaigns.add(campaign, contact, text, len(recipients))
+        self._wake.set()
+        return campaign
+
+    def start(self, api):
+        self._task = asyncio.ensure_future(self._run(api))
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self, api):
+        while True:
+            try:
+                messages = await self._database.outbox.claim(self._batch_size, self._lease)
+                if messages:
+                    await self._send(api, messages)
+                    continue
+
+                # Summaries that failed, or whose sender died, are sent again while idle
+                for campaign in await self._database.campaigns.unfinished():
+                    await self._update(api, campaign['_id'], 0)
+            except Exception:
+                logger.exception('Failed to drain the outbox')
+
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self._interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, api, messages):
+        messages = {message['_id']: message for message in messages}
+
+        async def send(id):
+            await api.messages.create(
+                None,
+                None,
+                messages[id]['to'],
+                messages[id]['text'])
+
+        fanout = FanOut(send, self._concurrency, errors=(SparkApiError,))
+        failures = await fanout.run(messages)
+
+        await self._database.outbox.delivered([id for id in messages if id not in failures])
+
+        processed = {}
+        for id, message in messages.items():
+            processed.setdefault(message['campaign'], 0)
+            if id not in failures:
+                processed[message['campaign']] += 1
+                continue
+
+            error = failures[id]
+            rate_limited = isinstance(error, RateLimitError)
+            if _retryable(error) and message['attempts'] < self._max_attempts:
+                await self._database.outbox.release(id)
+                continue
+
+            logger.warn('Can not send message to {}: {}'.format(message['to'], error))
+            await self._database.outbox.failed(id, str(error), rate_limited)
+            processed[message['campaign']] += 1
+
+        for campaign, count in processed.items():
+            await self._update(api, campaign, count)
+
+    async def _update(self, api, campaign, count):
+        # One campaign failing must not keep the others in the batch from their summary
+        try:
+            await self._progress(api, campaign, count)
+            await self._finish(api, campaign)
+        except Exception:
+            logger.exception('Failed to update campaign {}'.format(campaign))
+
+    async def _progress(self, api, campaign, count):
+        if not count:
+            return
+
+        campaign = await self._database.campaigns.processed(campaign, count)
+        if not campaign or campaign['total'] < self._progress_interval or campaign['processed'] >= campaign['total']:
+            return
+
+        interval = self._progress_interval
+        if campaign['processed'] // interval > (campaign['processed'] - count) // interval:
+            await api.messages.create(
+                None,
+                None,
+                campaign['contact'],
+                'Asked {} of {} customers'.format(campaign['processed'], campaign['total']))
+
+    async def _finish(self, api, campaign):
+        if await self._database.outbox.unfinished(campaign):
+            return
+
+        campaign = await self._database.campaigns.claim(campaign, self._lease)
+        if not campaign:
+            return
+
+        # The campaign is only done once the whole summary went out, until then it is retried
+        try:
+            failures = await self._database.outbox.failures(campaign['_id'])
+            # Being rate limited says nothing about the address, so it is reported separately
+            limited = sorted(failure['to'] for failure in failures if failure.get('rate_limited'))
+            failed = sorted(failure['to'] for failure in failures if not failure.get('rate_limited'))
+            pages = []
+            if failed:
+                pages.extend(paginate('Not able to send messages to:', failed))
+            if limited:
+                pages.extend(paginate('Spark is rate limiting us, the question did not reach:', limited))
+            pages.append('All customers asked')
+
+            for page in pages:
+                await api.messages.create(
+                    None,
+                    None,
+                    campaign['contact'],
+                    None,
+                    page)
+        except Exception:
+            # A contact that can not be reached at all should not be retried forever
+            if campaign.get('summary_attempts', 0) + 1 < self._max_attempts:
+                await self._database.campaigns.release(campaign['_id'])
+                raise
+            logger.exception('Giving up on the summary of campaign {}'.format(campaign['_id']))
+
+        await self._database.campaigns.finish(campaign['_id'])
+
+
+def _retryable(error):
+    # Rate limits, network errors and server errors may pass, a rejected address will not
+    return error.status is None or error.status == 429 or error.status >= 500
@@ -0,0 +1,19 @@
+# Spark refuses messages above 7439 bytes, leave some room for the markdown rendering
+MESSAGE_LIMIT = 7000
+
+
+def paginate(header, items, limit=MESSAGE_LIMIT):
+    pages = []
+    lines = [header]
+    size = len(header.encode())
+    for item in items:
+        line = ' * {}'.format(item)
+        length = len(line.encode()) + 1
+        if len(lines) > 1 and size + length > limit:
+            pages.append('\n'.join(lines))
+            lines = ['{} (continued)'.format(header)]
+            size = len(lines[0].encode())
+        lines.append(line)
+        size += length
+    pages.append('\n'.join(lines))
+    return pages
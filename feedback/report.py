@@ -0,0 +1,118 @@
+import io
+import itertools
+import collections
+
+import docx
+import pymongo
+
+from spark.metrics import REGISTRY
+from spark.pools import Pool
+
+LOOKUPS = REGISTRY.counter('feedback_report_cache_total', 'Answer document cache lookups', ['result'])
+BUILD_SECONDS = REGISTRY.histogram('feedback_report_build_seconds', 'Time spent building answer documents')
+
+
+DOCX_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+_clients = {}
+
+
+class Reports:
+    def __init__(self, uri, name, workers=2, batch_size=500):
+        self._uri = uri
+        self._name = name
+        self._batch_size = batch_size
+        # Building documents is CPU bound, so it is kept out of the event loop process altogether
+        self._pool = Pool.processes('reports', workers)
+
+    async def build(self, question, after=None):
+        with BUILD_SECONDS.time():
+            return await self._pool.run(
+                build_report,
+                self._uri,
+                self._name,
+                question,
+                self._batch_size,
+                after,
+            )
+
+    def close(self):
+        self._pool.close()
+
+
+class ReportCache:
+    def __init__(self, reports, answers, size=100, max_bytes=64 * 1024 * 1024):
+        self._reports = reports
+        self._answers = answers
+        self._size = size
+        self._max_bytes = max_bytes
+        # Least recently fetched first, bounded by count and by the size of the documents
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, contact, question):
+        # Answers are only ever appended or removed, so count and newest answer tell if the document is stale
+        tag = await self._answers.tag(question)
+        entry = self._entries.get(contact)
+        if entry and entry[0] == question and entry[1] == tag:
+            self._entries.move_to_end(contact)
+            self.hits += 1
+            LOOKUPS.inc(result='hit')
+            return entry[2], tag
+
+        self.misses += 1
+        LOOKUPS.inc(result='miss')
+        document = await self._reports.build(question)
+        self._store(contact, (question, tag, document))
+        return document, tag
+
+    def invalidate(self, contact):
+        entry = self._entries.pop(contact, None)
+        if entry:
+            self._bytes -= len(entry[2])
+
+    def _store(self, contact, entry):
+        self.invalidate(contact)
+        self._entries[contact] = entry
+        self._bytes += len(entry[2])
+        while self._entries and (len(self._entries) > self._size or self._bytes > self._max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted[2])
+
+
+def build_report(uri, name, question, batch_size, after=None):
+    database = _database(uri, name)
+    text = database['questions'].find_one({'_id': question}, {'text': True})['text']
+
+    document = docx.Document()
+    document.add_heading(text, 0)
+
+    query = {'question': question}
+    if after:
+        query['created'] = {'$gt': after}
+
+    # The cursor fetches answers batch by batch, only with the fields the document needs
+    answers = database['answers'].find(
+        query,
+        {'_id': False, 'customer': True, 'email': True, 'text': True},
+        sort=[('customer', pymongo.ASCENDING), ('email', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+        batch_size=batch_size,
+    )
+    for (customer, email), respondent in itertools.groupby(answers, lambda answer: (answer['customer'], answer['email'])):
+        document.add_heading('Customer: {}, email: {}'.format(customer, email), 3)
+
+        for answer in respondent:
+            document.add_paragraph(answer['text'], style='List Number')
+
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+def _database(uri, name):
+    # Every worker process needs a client of its own, they can not be shared across a fork
+    if uri not in _clients:
+        _clients[uri] = pymongo.MongoClient(uri)
+    return _clients[uri][name]
@@ -0,0 +1,107 @@
+import os
+import copy
+import time
+import signal
+import logging
+import multiprocessing
+import multiprocessing.connection
+
+import feedback
+
+logger = logging.getLogger('Feedback')
+
+
+def supervise(config, workers):
+    if not config.get('persistent_dedup', True):
+        logger.warn('Workers can only share deduplication through MongoDB, enabling persistent_dedup')
+
+    processes = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        # The primary registers the webhooks and migrates the database, the others wait for it
+        if not _start_primary(config, processes):
+            if stopping:
+                return 0
+            logger.error('Primary worker failed to start')
+            return 1
+        for index in range(1, workers):
+            if stopping:
+                break
+            processes[index] = _start(config, index)
+
+        while processes:
+            multiprocessing.connection.wait([process.sentinel for process in processes.values()])
+            for index, process in list(processes.items()):
+                if process.is_alive():
+                    continue
+
+                del processes[index]
+                if stopping:
+                    continue
+
+                logger.warn('Worker {} exited with {}, restarting it'.format(index, process.exitcode))
+                time.sleep(1)
+                if index:
+                    processes[index] = _start(config, index)
+                    continue
+
+                # The other workers keep serving while the primary is retried
+                delay = 1
+                while not _start_primary(config, processes) and not stopping:
+                    logger.warn('Primary worker failed to start, retrying in {} seconds'.format(delay))
+                    time.sleep(delay)
+                    delay = min(delay * 2, 60)
+    except KeyboardInterrupt:
+        # The interrupt may have been sent to the supervisor alone, so pass it on
+        stop(None, None)
+    except Exception:
+        logger.exception('Supervisor failed, stopping the workers')
+        stop(None, None)
+
+    for process in processes.values():
+        process.join()
+    return 0
+
+
+def _start_primary(config, processes):
+    # Registered before it is ready, so a SIGTERM to the supervisor reaches it while we wait
+    ready = multiprocessing.Event()
+    processes[0] = _start(config, 0, ready)
+    while not ready.wait(1):
+        if not processes[0].is_alive():
+            del processes[0]
+            return False
+    return True
+
+
+def _start(config, index, ready=None):
+    worker = copy.deepcopy(config)
+    worker['bot']['reuse_port'] = True
+    worker['bot']['primary'] = index == 0
+    worker['persistent_dedup'] = True
+    worker['shared_cache'] = True
+    worker['sender_lock'] = True
+    worker['supervised'] = True
+
+    process = multiprocessing.Process(target=_run, args=(worker, ready), name='feedback-{}'.format(index))
+    process.start()
+    return process
+
+
+def _run(config, ready):
+    # Forked from the supervisor, which stops workers through SIGINT instead
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    bot = feedback.Feedback(config)
+    if ready:
+        ready.set()
+    bot.run()
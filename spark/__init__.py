@@ -0,0 +1,352 @@
+import functools
+import asyncio
+import logging
+from aiohttp import web
+
+from spark.client import Client, SparkApiError, RateLimitError, SparkData, DEFAULT_URL
+from spark.dedup import MemoryDedup, MongoDedup
+from spark.lock import MongoLock
+from spark.dispatch import Dispatcher
+from spark.router import Router
+from spark.metrics import REGISTRY
+from spark.watchdog import Watchdog
+
+logger = logging.getLogger('Spark')
+
+WEBHOOKS = REGISTRY.counter('spark_webhooks_total', 'Webhook events received', ['hook', 'result'])
+WEBHOOK_SECONDS = REGISTRY.histogram('spark_webhook_seconds', 'Time spent handling webhook events', ['hook'])
+COMMAND_SECONDS = REGISTRY.histogram('spark_command_seconds', 'Time spent in message handlers', ['command'])
+DEDUP = REGISTRY.counter('spark_dedup_total', 'Message ids checked for redeliveries', ['result'])
+
+
+async def dummy(*args, **kwargs):
+    pass
+
+
+class Server:
+    def __init__(self, config, loop, dedup=None, lock=None):
+        self._loop = loop
+        self._config = config
+        # The dispatcher keeps a sender's events in order within a process, the lock across processes
+        self._lock = lock
+        self._id = None
+        self._displayname = None
+        # With several workers behind one port only the primary manages the webhooks
+        self._primary = config.get('primary', True)
+        self._api = Client(
+            config['token'],
+            config.get('api_url', DEFAULT_URL),
+            config.get('connection_limit', 100),
+            config.get('connection_limit_per_host', 30),
+            config.get('timeout', 60),
+            config.get('rate_limit', 20),
+            config.get('rate_burst', 20),
+            config.get('max_retries', 5),
+            config.get('retry_backoff', 1.0),
+            config.get('inbound_pool_size', 30),
+            config.get('outbound_pool_size', 30),
+        )
+        self._router = Router()
+        self._hooks = {}
+        self._webhooks = set()
+        self._get_routes = {}
+        self._post_routes = {}
+        self._default_message = dummy
+        self._pre_message = dummy
+        self._on_startup = dummy
+        self._on_room_created = dummy
+        self._fetching = {}
+        self._listener = None
+        self._dispatcher = Dispatcher(
+            self._dispatch,
+            config.get('workers', 8),
+            config.get('queue_size', 1000),
+        )
+        self._dedup = dedup or MemoryDedup(
+            config.get('dedup_size', 10000),
+            config.get('dedup_age', 3600),
+        )
+        self._watchdog = None
+        if config.get('watchdog', True):
+            self._watchdog = Watchdog(
+                loop,
+                config.get('stall_threshold', 0.25),
+                config.get('watchdog_interval', 0.1),
+            )
+        REGISTRY.gauge('spark_queue_depth', 'Webhook events waiting to be handled', function=lambda: len(self._dispatcher))
+        if config.get('metrics', True):
+            self.add_get('/metrics', self._metrics)
+
+    @property
+    def watchdog(self):
+        return self._watchdog
+
+    def listen(self, match, callback):
+        self._watch(callback)
+        self._router.add(match, callback)
+
+    def default_message(self, callback):
+        self._watch(callback)
+        self._default_message = callback
+
+    def pre_message(self, callback):
+        self._pre_message = callback
+
+    def on_startup(self, callback):
+        self._on_startup = callback
+
+    def roomcreation(self, callback):
+        self._on_room_created = callback
+
+    @property
+    def primary(self):
+        return self._primary
+
+    async def setup(self):
+        self._register_webhooks()
+        await self._dedup.setup()
+        if self._lock:
+            await self._lock.setup()
+        if self._primary:
+            await asyncio.gather(self._get_self(), self._reconcile_webhooks())
+        else:
+            await self._get_self()
+        await self._on_startup(self._api)
+        self._dispatcher.start()
+        if self._watchdog:
+            self._watchdog.start()
+        return await self._setup_webserver()
+
+    async def cleanup(self, keep_webhooks=None):
+        if keep_webhooks is None:
+            keep_webhooks = self._config.get('keep_webhooks', False)
+        if self._watchdog:
+            self._watchdog.stop()
+        # Stop taking events first, then finish the ones that were already acknowledged
+        timeout = self._config.get('shutdown_timeout', 30)
+        if self._listener:
+            self._listener.close()
+            await self._application.shutdown()
+            await self._handler.shutdown(timeout)
+            await self._listener.wait_closed()
+            await self._application.cleanup()
+            self._listener = None
+        await self._dispatcher.stop(timeout)
+        # Leaving the webhooks in place lets Spark retry whatever arrives while we restart
+        if self._primary and not keep_webhooks:
+            await self._remove_webhooks()
+        await self._api.close()
+
+    async def _handle_message(self, message):
+        callback, args = self._router.match(message.text or '')
+
+        await self._pre_message(self._loop, self._api, message)
+        if callback:
+            with COMMAND_SECONDS.time(command=callback.__name__):
+                await callback(self._api, message, args)
+        else:
+            with COMMAND_SECONDS.time(command=self._default_message.__name__):
+                await self._default_message(self._api, message)
+
+    async def _message_created(self, webhook_data):
+        if webhook_data['data']['personId'] == self._id:
+            return
+
+        message_id = webhook_data['data']['id']
+        if message_id in self._fetching:
+            # A redelivery of a message we are already fetching rides on that fetch
+            DEDUP.inc(result='merged')
+            await asyncio.wait([self._fetching[message_id]])
+            return
+
+        if await self._dedup.seen(message_id):
+            DEDUP.inc(result='duplicate')
+            return
+        DEDUP.inc(result='new')
+
+        fetch = asyncio.ensure_future(self._api.messages.get(message_id))
+        self._fetching[message_id] = fetch
+        try:
+            message = await fetch
+        except Exception:
+            # The client already retried the fetch and Spark got its 200, so the event is lost.
+            # Forget the id so that a redelivery of it is not taken for a duplicate.
+            logger.error('Dropping message {}, it could not be fetched'.format(message_id))
+            await self._dedup.forget(message_id)
+            raise
+        finally:
+            del self._fetching[message_id]
+
+        await self._handle_message(message)
+
+    async def _room_created(self, webhook_data):
+        if not webhook_data['data']['personId'] == self._id:
+            return
+
+        person = await self._api.people.get(webhook_data['actorId'])
+
+        await self._on_room_created(
+            self._api,
+            webhook_data['data']['roomId'],
+            webhook_data['data']['id'],
+            person,
+        )
+
+    async def _webhook_notified(self, request):
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        if not isinstance(data, dict) or not isinstance(data.get('data'), dict):
+            return web.Response(status=400)
+
+        name = data.get('name')
+        if name not in self._hooks:
+            # The name comes from the request, only known names may become label values
+            WEBHOOKS.inc(hook='unknown', result='ignored')
+            return web.Response()
+
+        # Spark retries the event later if we are too far behind
+        if not self._dispatcher.submit(self._sender(data), data):
+            WEBHOOKS.inc(hook=name, result='rejected')
+            return web.Response(status=503)
+
+        WEBHOOKS.inc(hook=name, result='accepted')
+        return web.Response()
+
+    def _sender(self, data):
+        # actorId is the person behind the event, for messages that is the author
+        return data.get('actorId') or data['data'].get('personId') or data['data'].get('personEmail')
+
+    async def _dispatch(self, data):
+        if not self._lock:
+            with WEBHOOK_SECONDS.time(hook=data['name']):
+                await self._hooks[data['name']](data)
+            return
+
+        sender = self._sender(data)
+        await self._lock.acquire(sender)
+        try:
+            with WEBHOOK_SECONDS.time(hook=data['name']):
+                await self._hooks[data['name']](data)
+        finally:
+            await self._lock.release(sender)
+
+    async def _metrics(self, api, request):
+        return REGISTRY.render(), 200, 'text/plain'
+
+    async def _setup_webserver(self):
+        self._application = web.Application()
+        self._application.router.add_post(
+            '/',
+            self._webhook_notified
+        )
+
+        for route, callback in self._get_routes.items():
+            self._application.router.add_get(
+                route,
+                functools.partial(
+                    self._handle_get,
+                    callback,
+                )
+            )
+        for route, callback in self._post_routes.items():
+            self._application.router.add_post(
+                route,
+                functools.partial(
+                    self._handle_post,
+                    callback,
+                )
+            )
+
+        self._handler = self._application.make_handler()
+        self._listener = await self._loop.create_server(
+            self._handler,
+            '127.0.0.1',
+            self._config['port'],
+            reuse_port=self._config.get('reuse_port', False),
+        )
+        return self._listener
+
+    async def _handle_get(self, callback, request):
+        result = await callback(self._api, request)
+        # Streaming callbacks prepare and write the response themselves
+        if isinstance(result, web.StreamResponse):
+            return result
+
+        content_type = 'text/html'
+        if len(result) == 3:
+            text, code, content_type = result
+        else:
+            text, code = result
+
+        return web.Response(
+            text=text,
+            content_type=content_type,
+            status=code,
+        )
+
+    async def _handle_post(self, callback, request):
+        code = await callback(self._api, request)
+        return web.Response(status=code)
+
+    def add_get(self, route, callback):
+        self._watch(callback)
+        self._get_routes[route] = callback
+
+    def add_post(self, route, callback):
+        self._watch(callback)
+        self._post_routes[route] = callback
+
+    def _watch(self, callback):
+        # Lets the watchdog name the handler that was running when the loop stalled
+        if self._watchdog:
+            self._watchdog.register(callback)
+
+    async def _get_self(self):
+        me = await self._api.people.me()
+        self._id = me.id
+        self._displayname = me.displayName.replace(' (bot)', '')
+
+    def _register_webhooks(self):
+        if self._router or self._default_message:
+            self._add_webhook(
+                'message created',
+                'messages',
+                'created',
+                self._message_created,
+            )
+        if self._on_room_created:
+            self._add_webhook(
+                'room created',
+                'memberships',
+                'created',
+                self._room_created,
+            )
+
+    def _add_webhook(self, name, resource, event, callback):
+        self._hooks[name] = callback
+        self._webhooks.add((name, self._config['webhook'], resource, event))
+
+    async def _reconcile_webhooks(self):
+        kept = {}
+        stale = []
+        for hook in await self._api.webhooks.list():
+            key = (hook.name, hook.targetUrl, hook.resource, hook.event)
+            # Copies, disabled hooks and filters or secrets we did not ask for are replaced
+            if key in self._webhooks and key not in kept and hook.status in (None, 'active') \
+                    and not hook.filter and not hook.secret:
+                kept[key] = hook
+            else:
+                stale.append(hook)
+
+        missing = [key for key in self._webhooks if key not in kept]
+        await asyncio.gather(
+            *[self._api.webhooks.delete(hook.id) for hook in stale],
+            *[self._api.webhooks.create(*key) for key in missing])
+        logger.info('Webhooks: {} kept, {} created, {} removed'.format(len(kept), len(missing), len(stale)))
+
+    async def _remove_webhooks(self):
+        hooks = await self._api.webhooks.list()
+        await asyncio.gather(*[self._api.webhooks.delete(hook.id) for hook in hooks])
@@ -0,0 +1,260 @@
+import os
+import random
+import asyncio
+import contextlib
+
+import aiohttp
+
+from spark.ratelimit import TokenBucket
+from spark.metrics import REGISTRY
+from spark.pools import Pool
+
+REQUESTS = REGISTRY.counter('spark_api_requests_total', 'Requests made to the Spark API', ['endpoint', 'status'])
+REQUEST_SECONDS = REGISTRY.histogram('spark_api_request_seconds', 'Spark API request latency', ['endpoint'])
+
+
+DEFAULT_URL = 'https://api.ciscospark.com/v1/'
+
+
+class SparkApiError(Exception):
+    def __init__(self, status, message, retry_after=None):
+        super().__init__('{}: {}'.format(status, message))
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+class RateLimitError(SparkApiError):
+    pass
+
+
+class SparkData:
+    def __init__(self, json_data):
+        self._json = json_data
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        # Mirrors ciscosparkapi, where optional fields are None when absent
+        return self._json.get(name)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, self._json)
+
+
+class Messages:
+    def __init__(self, client):
+        self._client = client
+
+    async def get(self, messageId):
+        data = await self._client.request('GET', 'messages/{}'.format(messageId))
+        return SparkData(data)
+
+    async def create(self, roomId=None, toPersonId=None, toPersonEmail=None, text=None, markdown=None, files=None):
+        fields = {
+            'roomId': roomId,
+            'toPersonId': toPersonId,
+            'toPersonEmail': toPersonEmail,
+            'text': text,
+            'markdown': markdown,
+        }
+        fields = {key: value for key, value in fields.items() if value is not None}
+
+        if not files:
+            data = await self._client.request('POST', 'messages', json=fields)
+            return SparkData(data)
+
+        # Spark only accepts a single attachment per message
+        with _open_file(files[0]) as (filename, content, content_type):
+            # A form can only be sent once, so a retried request needs a new one
+            def form():
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                form = aiohttp.FormData()
+                for key, value in fields.items():
+                    form.add_field(key, value)
+                form.add_field('files', content, filename=filename, content_type=content_type)
+                return form
+
+            data = await self._client.request('POST', 'messages', data=form)
+        return SparkData(data)
+
+
+class People:
+    def __init__(self, client):
+        self._client = client
+
+    async def get(self, personId):
+        data = await self._client.request('GET', 'people/{}'.format(personId))
+        return SparkData(data)
+
+    async def me(self):
+        data = await self._client.request('GET', 'people/me')
+        return SparkData(data)
+
+
+class Webhooks:
+    def __init__(self, client):
+        self._client = client
+
+    async def list(self):
+        return [SparkData(item) for item in await self._client.items('webhooks')]
+
+    async def create(self, name, targetUrl, resource, event, filter=None, secret=None):
+        fields = {
+            'name': name,
+            'targetUrl': targetUrl,
+            'resource': resource,
+            'event': event,
+        }
+        if filter:
+            fields['filter'] = filter
+        if secret:
+            fields['secret'] = secret
+
+        data = await self._client.request('POST', 'webhooks', json=fields)
+        return SparkData(data)
+
+    async def delete(self, webhookId):
+        await self._client.request('DELETE', 'webhooks/{}'.format(webhookId))
+
+
+class Client:
+    def __init__(self, access_token, base_url=DEFAULT_URL, limit=100, limit_per_host=30, timeout=60,
+                 rate=20, burst=20, retries=5, backoff=1.0, inbound=30, outbound=30):
+        self._access_token = access_token
+        self._retries = retries
+        self._backoff = backoff
+        self._base_url = base_url if base_url.endswith('/') else base_url + '/'
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._timeout = timeout
+        # Fetches for incoming webhooks get their own slots, connections and rate limit,
+        # so a large fan-out or document upload can not hold them up. Spark limits
+        # each endpoint on its own, so a 429 on sends says nothing about fetches.
+        self._classes = {
+            'GET': (Pool('spark-inbound', inbound), TokenBucket(rate, burst)),
+            None: (Pool('spark-outbound', outbound), TokenBucket(rate, burst)),
+        }
+        self._sessions = {}
+        self.messages = Messages(self)
+        self.people = People(self)
+        self.webhooks = Webhooks(self)
+
+    async def request(self, method, path, **kwargs):
+        data, _ = await self._send(method, self._base_url + path, _endpoint(method, path), **kwargs)
+        return data
+
+    async def items(self, path):
+        result = []
+        url = self._base_url + path
+        while url:
+            data, links = await self._send('GET', url, _endpoint('GET', path))
+            result.extend(data.get('items', []))
+            url = links.get('next', {}).get('url')
+        return result
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions = {}
+
+    async def _send(self, method, url, endpoint, data=None, **kwargs):
+        pool, bucket = self._classes.get(method, self._classes[None])
+        attempt = 0
+        while True:
+            await bucket.acquire()
+            try:
+                # The slot is only held for one attempt, not while backing off
+                return await pool.run(
+                    self._send_once,
+                    pool.name,
+                    method,
+                    url,
+                    endpoint,
+                    data() if callable(data) else data,
+                    **kwargs)
+            except SparkApiError as e:
+                if attempt >= self._retries or not _retryable(method, e):
+                    raise
+
+                # Full jitter, so requests that were limited together do not retry together
+                delay = random.uniform(0, self._backoff * 2 ** attempt)
+                if e.retry_after is not None:
+                    bucket.pause(e.retry_after)
+                    delay += e.retry_after
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def _send_once(self, pool, method, url, endpoint, data, **kwargs):
+        try:
+            return await self._request(pool, method, url, endpoint, data, **kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Callers only have to handle one error type, whether Spark or the network failed
+            REQUESTS.inc(endpoint=endpoint, status='error')
+            raise SparkApiError(None, str(e) or type(e).__name__)
+
+    async def _request(self, pool, method, url, endpoint, data, **kwargs):
+        session = self._get_session(pool)
+        with REQUEST_SECONDS.time(endpoint=endpoint):
+            async with session.request(method, str(url), data=data, **kwargs) as response:
+                REQUESTS.inc(endpoint=endpoint, status=response.status)
+                if response.status == 429:
+                    raise RateLimitError(
+                        response.status,
+                        await response.text(),
+                        _retry_after(response.headers.get('Retry-After')))
+
+                if response.status >= 400:
+                    raise SparkApiError(
+                        response.status,
+                        await response.text(),
+                        _retry_after(response.headers.get('Retry-After')))
+
+                if response.status == 204:
+                    return None, response.links
+                return await response.json(), response.links
+
+    def _get_session(self, pool):
+        # Sessions have to be created from within the running event loop
+        if pool not in self._sessions:
+            connector = aiohttp.TCPConnector(
+                limit=self._limit,
+                limit_per_host=self._limit_per_host,
+            )
+            self._sessions[pool] = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self._timeout),
+                headers={'Authorization': 'Bearer {}'.format(self._access_token)},
+            )
+        return self._sessions[pool]
+
+
+def _endpoint(method, path):
+    # people/me and people/<id> are one endpoint as far as latency goes
+    return '{} {}'.format(method, path.split('/')[0])
+
+
+def _retryable(method, error):
+    if isinstance(error, RateLimitError):
+        return True
+    # Webhooks are acknowledged before the message is fetched, so Spark will not
+    # retry a failed fetch for us. Sends are not retried, they may have gone out.
+    return method == 'GET' and (error.status is None or error.status >= 500)
+
+
+def _retry_after(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+@contextlib.contextmanager
+def _open_file(entry):
+    if isinstance(entry, tuple):
+        yield entry
+        return
+
+    with open(entry, 'rb') as fd:
+        yield os.path.basename(entry), fd, None
@@ -0,0 +1,82 @@
+import time
+import datetime
+import collections
+
+import pymongo
+
+
+class MemoryDedup:
+    def __init__(self, size=10000, age=3600):
+        self._size = size
+        self._age = age
+        # Insertion ordered, so the oldest ids are always at the front
+        self._seen = collections.OrderedDict()
+
+    async def setup(self):
+        pass
+
+    async def seen(self, key):
+        return self.check(key)
+
+    def check(self, key):
+        now = time.monotonic()
+        self._expire(now)
+        if key in self._seen:
+            return True
+
+        self._seen[key] = now
+        if len(self._seen) > self._size:
+            self._seen.popitem(last=False)
+        return False
+
+    async def forget(self, key):
+        self._seen.pop(key, None)
+
+    def __len__(self):
+        return len(self._seen)
+
+    def _expire(self, now):
+        while self._seen:
+            key, added = next(iter(self._seen.items()))
+            if now - added < self._age:
+                return
+            self._seen.popitem(last=False)
+
+
+class MongoDedup:
+    def __init__(self, collection, run, size=10000, age=3600):
+        self._collection = collection
+        self._run = run
+        self._age = age
+        self._local = MemoryDedup(size, age)
+
+    async def setup(self):
+        # Mongo removes old ids by itself through the TTL index
+        await self._run(
+            self._collection.create_index,
+            'created',
+            expireAfterSeconds=self._age,
+        )
+
+    async def seen(self, key):
+        if self._local.check(key):
+            return True
+
+        try:
+            await self._run(
+                self._collection.insert_one,
+                {'_id': key, 'created': datetime.datetime.utcnow()},
+            )
+        except pymongo.errors.DuplicateKeyError:
+            return True
+        except Exception:
+            await self._local.forget(key)
+            raise
+        return False
+
+    async def forget(self, key):
+        await self._local.forget(key)
+        await self._run(self._collection.delete_one, {'_id': key})
+
+    def __len__(self):
+        return len(self._local)
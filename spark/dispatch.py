@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import collections
+
+logger = logging.getLogger('Spark')
+
+
+class Dispatcher:
+    def __init__(self, handler, workers=8, queue_size=1000):
+        self._handler = handler
+        self._workers = workers
+        self._queue_size = queue_size
+        self._pending = 0
+        # One queue of events per sender. A sender is only ever in _ready once,
+        # so no two workers handle events from the same sender at the same time
+        self._partitions = {}
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = []
+
+    def submit(self, key, event):
+        if self._pending >= self._queue_size:
+            return False
+
+        self._pending += 1
+        self._idle.clear()
+        if key in self._partitions:
+            self._partitions[key].append(event)
+        else:
+            self._partitions[key] = collections.deque([event])
+            self._ready.put_nowait(key)
+        return True
+
+    def start(self):
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self._workers)]
+
+    async def stop(self, timeout=None):
+        # Events were acknowledged when they were queued, Spark will not send them again
+        if self._tasks and timeout:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warn('Dropping {} webhook events that were not handled in time'.format(self._pending))
+
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+        self._tasks = []
+
+    def __len__(self):
+        return self._pending
+
+    async def _work(self):
+        while True:
+            key = await self._ready.get()
+            events = self._partitions[key]
+            # The event stays queued while it runs, so new events for this
+            # sender are appended behind it instead of creating a new partition
+            event = events[0]
+            try:
+                await self._handler(event)
+            except Exception:
+                logger.exception('Failed to handle {} event'.format(event.get('name')))
+            finally:
+                events.popleft()
+                self._pending -= 1
+                if not self._pending:
+                    self._idle.set()
+                if events:
+                    # Go to the back of the line so busy senders can not starve others
+                    self._ready.put_nowait(key)
+                else:
+                    del self._partitions[key]
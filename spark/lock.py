@@ -0,0 +1,44 @@
+import uuid
+import asyncio
+import datetime
+
+import pymongo
+
+
+class MongoLock:
+    def __init__(self, collection, run, lease=300, poll=0.05):
+        self._collection = collection
+        self._run = run
+        self._lease = lease
+        self._poll = poll
+        self._owner = uuid.uuid4().hex
+
+    async def setup(self):
+        # Locks of a worker that died are removed by Mongo once their lease is over
+        await self._run(
+            self._collection.create_index,
+            'expires',
+            expireAfterSeconds=0,
+        )
+
+    async def acquire(self, key):
+        while not await self._run(self._acquire, key):
+            await asyncio.sleep(self._poll)
+
+    async def release(self, key):
+        await self._run(self._collection.delete_one, {'_id': key, 'owner': self._owner})
+
+    def _acquire(self, key):
+        now = datetime.datetime.utcnow()
+        expires = now + datetime.timedelta(seconds=self._lease)
+        try:
+            self._collection.insert_one({'_id': key, 'owner': self._owner, 'expires': expires})
+            return True
+        except pymongo.errors.DuplicateKeyError:
+            pass
+
+        # The TTL monitor only runs once a minute, so take over expired leases right away
+        taken = self._collection.find_one_and_update(
+            {'_id': key, 'expires': {'$lt': now}},
+            {'$set': {'owner': self._owner, 'expires': expires}})
+        return taken is not None
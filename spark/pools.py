@@ -0,0 +1,71 @@
+import time
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from spark.metrics import REGISTRY
+
+WAIT_SECONDS = REGISTRY.histogram('pool_wait_seconds', 'Time spent queued for a free pool slot', ['pool'])
+SIZE = REGISTRY.gauge('pool_size', 'Slots per pool', ['pool'])
+BUSY = REGISTRY.gauge('pool_busy', 'Pool slots in use', ['pool'])
+WAITING = REGISTRY.gauge('pool_waiting', 'Calls queued for a pool slot', ['pool'])
+UTILIZATION = REGISTRY.gauge('pool_utilization', 'Share of pool slots in use', ['pool'])
+BUSY_SECONDS = REGISTRY.counter('pool_busy_seconds_total', 'Slot seconds spent running calls, divide its rate by the size for utilization', ['pool'])
+
+
+class Pool:
+    def __init__(self, name, size, executor=None):
+        self.name = name
+        self.size = max(1, size)
+        self.busy = 0
+        self.waiting = 0
+        self._executor = executor
+        self._slots = asyncio.Semaphore(self.size)
+        SIZE.set(self.size, pool=name)
+        self._update()
+
+    @classmethod
+    def threads(cls, name, size):
+        return cls(name, size, ThreadPoolExecutor(max_workers=max(1, size), thread_name_prefix=name))
+
+    @classmethod
+    def processes(cls, name, size):
+        # Forking a process that already runs threads can leave their locks held in the child
+        context = multiprocessing.get_context('forkserver')
+        return cls(name, size, ProcessPoolExecutor(max_workers=max(1, size), mp_context=context))
+
+    async def run(self, function, *args, **kwargs):
+        # Slots are handed out here rather than in the executor's own queue,
+        # so the wait is measured in the event loop for process pools as well
+        queued = time.monotonic()
+        self.waiting += 1
+        self._update()
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        started = time.monotonic()
+        WAIT_SECONDS.observe(started - queued, pool=self.name)
+
+        self.busy += 1
+        self._update()
+        try:
+            if self._executor:
+                loop = asyncio.get_event_loop()
+                return await loop.run_in_executor(self._executor, functools.partial(function, *args, **kwargs))
+            return await function(*args, **kwargs)
+        finally:
+            BUSY_SECONDS.inc(time.monotonic() - started, pool=self.name)
+            self.busy -= 1
+            self._update()
+            self._slots.release()
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+
+    def _update(self):
+        BUSY.set(self.busy, pool=self.name)
+        WAITING.set(self.waiting, pool=self.name)
+        UTILIZATION.set(self.busy / self.size, pool=self.name)
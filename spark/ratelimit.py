@@ -0,0 +1,32 @@
+import time
+import asyncio
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._capacity = max(1, burst)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+
+    async def acquire(self):
+        if not self._rate:
+            return
+
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+    def pause(self, seconds):
+        # Spark told us to back off, which holds for every request, not only the one that got the 429
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
@@ -0,0 +1,37 @@
+import re
+
+
+class Router:
+    def __init__(self):
+        self._routes = []
+        self._pattern = None
+
+    def add(self, match, callback):
+        self._routes.append((match, callback))
+        self._pattern = None
+
+    def match(self, text):
+        if not self._routes:
+            return None, None
+
+        if self._pattern is None:
+            self._compile()
+
+        found = self._pattern.match(text)
+        if not found:
+            return None, None
+
+        # The route group encloses any groups of the route itself, so it is always the last one closed
+        _, callback = self._routes[int(found.lastgroup[len('route'):])]
+        return callback, text[found.end():].strip()
+
+    def __len__(self):
+        return len(self._routes)
+
+    def _compile(self):
+        # All routes folded into one alternation, so a message is only scanned once.
+        # Matching is case insensitive, which leaves the arguments in their original case
+        self._pattern = re.compile(
+            '|'.join('(?P<route{}>{})'.format(index, match) for index, (match, _) in enumerate(self._routes)),
+            re.IGNORECASE,
+        )
@@ -0,0 +1,124 @@
+import sys
+import time
+import asyncio
+import logging
+import datetime
+import threading
+import traceback
+import collections
+
+from spark.metrics import REGISTRY
+
+logger = logging.getLogger('Spark')
+
+LAG = REGISTRY.histogram('spark_loop_lag_seconds', 'How late the event loop ran a scheduled heartbeat')
+STALLS = REGISTRY.counter('spark_loop_stalls_total', 'Event loop stalls above the threshold', ['handler'])
+
+
+class Watchdog:
+    def __init__(self, loop, threshold=0.25, interval=0.1, history=20, sample_interval=0.005):
+        self._loop = loop
+        self._threshold = threshold
+        self._interval = interval
+        self._sample_interval = sample_interval
+        self._handlers = {}
+        self._thread = None
+        self._thread_id = None
+        self._stopped = threading.Event()
+        self._heartbeat_handle = None
+        self._expected = None
+        self._captured = None
+        self._stall = None
+        self._samples = None
+        self._profile_until = 0
+        self.stalls = collections.deque(maxlen=history)
+
+    def register(self, callback):
+        function = getattr(callback, '__func__', callback)
+        code = getattr(function, '__code__', None)
+        if code:
+            self._handlers[code] = function.__qualname__
+
+    def start(self):
+        # Called from the loop, so this is the thread the watchdog keeps an eye on
+        self._thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._expected = time.monotonic()
+        self._heartbeat()
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._heartbeat_handle:
+            self._heartbeat_handle.cancel()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def profiling(self):
+        return self._samples is not None
+
+    async def profile(self, seconds):
+        samples = self._samples = collections.Counter()
+        self._profile_until = time.monotonic() + seconds
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self._samples = None
+        return samples
+
+    def _heartbeat(self):
+        now = time.monotonic()
+        lag = max(0.0, now - self._expected)
+        LAG.observe(lag)
+
+        stall = self._stall
+        if stall and lag >= self._threshold:
+            stall['duration'] = lag
+            self.stalls.append(stall)
+            STALLS.inc(handler=stall['handler'])
+            logger.warn('Event loop blocked for {:.3f}s in {}\n{}'.format(
+                lag,
+                stall['handler'],
+                ''.join(stall['stack'])))
+        self._stall = None
+
+        self._expected = now + self._interval
+        self._heartbeat_handle = self._loop.call_later(self._interval, self._heartbeat)
+
+    def _watch(self):
+        while not self._stopped.wait(self._sample_interval if self.profiling else self._interval / 2):
+            now = time.monotonic()
+            samples = self._samples
+            if samples is not None and now < self._profile_until:
+                frame = sys._current_frames().get(self._thread_id)
+                if frame:
+                    innermost = traceback.extract_stack(frame, 1)[0]
+                    samples[(self._handler(frame), '{}:{} in {}'.format(innermost.filename, innermost.lineno, innermost.name))] += 1
+
+            # Capture only once per stall, the stack is the same until the loop moves on
+            expected = self._expected
+            if now - expected < self._threshold or self._captured == expected:
+                continue
+
+            frame = sys._current_frames().get(self._thread_id)
+            if not frame:
+                continue
+            self._captured = expected
+            self._stall = {
+                'time': datetime.datetime.utcnow(),
+                'handler': self._handler(frame),
+                'stack': traceback.format_stack(frame),
+                'duration': now - expected,
+            }
+
+    def _handler(self, frame):
+        # A running coroutine's frames chain back through every coroutine awaiting it
+        while frame:
+            name = self._handlers.get(frame.f_code)
+            if name:
+                return name
+            frame = frame.f_back
+        return 'unknown'